@@ -1,25 +1,256 @@
 # c:\Users\itspr\DailyQuest\Qwen\api_server.py
 import asyncio
-import os
+import itertools
+import logging
+import math
+import mimetypes
+import time
 import uuid
+import zlib
+from collections import OrderedDict, deque
 from pathlib import Path
-from quart import Quart, request, jsonify, send_from_directory, current_app
+import json
+from quart import Quart, Response, g, request, jsonify, send_file, send_from_directory
 from quart_cors import cors
-from playwright.async_api import async_playwright, Browser, Page, Playwright
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page, Playwright
 from playwright_stealth import Stealth
-from utils import save_error_state, QWEN_URL, STATE_FILE
+from urllib.parse import urlparse, parse_qs
+from caching import MetadataCache, ResponseCache
+from jobs import Job, JobManager, JobQueueFullError
+from tracing import Tracer, current_request_id
+from artifacts import ErrorArtifactStore
+from logs import bind, parse_sample_rates, setup_logging
+from uploads import UploadStore, UploadTooLargeError
+from images import ImageStore
+from timeouts import StageTimeouts, TimeoutBudget, parse_timeout_limits, parse_timeout_overrides, timeout_key
+from extract import extract_history, extract_response, extract_texts, code_blocks_from_markdown
+from metrics import (
+    stage_timer, render_metrics, observe_request, update_pool_gauges, POOL_WAIT_SECONDS, UI_TOGGLES,
+)
+from utils import (
+    chat_id_from_url, parse_completion_stream,
+    QWEN_URL, STATE_FILE, CAPTURE_MODE, COMPLETION_URL_FRAGMENT,
+    AFFINITY_WINDOW, AFFINITY_MAX_SKIPS, percentile,
+    POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_GROW_WAIT, POOL_IDLE_TIMEOUT, POOL_SCALE_INTERVAL,
+    BROWSER_SHARDS, RECYCLE_MAX_REQUESTS, RECYCLE_MAX_HEAP_MB, RECYCLE_CHECK_EVERY,
+    PREWARM_PAGES, PREWARM_MODEL, PREWARM_WEB_SEARCH, POOL_MODEL_PINS,
+    MAX_QUEUE, DEFAULT_DEADLINE, DEFAULT_HOLD_TIME, METADATA_TTL, METADATA_MAX_STALE,
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_MB,
+    BLOCKED_RESOURCE_TYPES, BLOCKED_URL_PATTERNS, ALLOWED_URL_PATTERNS,
+    BATCH_MAX_ITEMS, BATCH_CONCURRENCY, JOB_CONCURRENCY, JOB_RETENTION, JOB_MAX_PENDING,
+    TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS, TRACE_MAX_EVENTS, TRACE_MAX_FILES, TRACE_DIR,
+    ERROR_ARTIFACT_DIR, ERROR_ARTIFACT_MAX_MB, ERROR_ARTIFACT_PER_MINUTE, ERROR_ARTIFACT_BURST, ERROR_CAPTURE_TIMEOUT,
+    LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE, LOG_QUEUE_SIZE,
+    UPLOAD_DIR, UPLOAD_STORE_MAX_MB, UPLOAD_MAX_FILE_MB, UPLOAD_MAX_TOTAL_MB, UPLOAD_MAX_FILES, UPLOAD_MEMORY_LIMIT_KB,
+    IMAGE_DIR, IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_WORKERS,
+    TIMEOUT_PERCENTILE, TIMEOUT_MARGIN, TIMEOUT_MIN_SAMPLES, TIMEOUT_WINDOW, TIMEOUT_LIMITS,
+)
+
+# Logs go through a queue to a writer thread; see logs.py.
+log_listener = setup_logging(LOG_LEVEL, LOG_FORMAT, parse_sample_rates(LOG_SAMPLE), LOG_QUEUE_SIZE)
+log = logging.getLogger("qwen.server")
+pool_log = logging.getLogger("qwen.pool")
+browser_log = logging.getLogger("qwen.browser")
+
+# --- Response Streaming ---
+# Listeners for the output of the response being generated, keyed by its page.
+_stream_listeners = {}
+
+# Watches the newest response bubble and reports `property` of its `selector` element to
+# Python whenever it changes: the text of a reply, or the markup of an image, which shows
+# no text while it is generated. Mutations are coalesced so a fast-typing response doesn't
+# flood the binding.
+STREAM_OBSERVER_JS = """
+([baseline, selector, property]) => {
+    if (window.__qwenStreamObserver) window.__qwenStreamObserver.disconnect();
+    let last = null;
+    let scheduled = false;
+    const flush = () => {
+        scheduled = false;
+        const containers = document.querySelectorAll('.response-meesage-container');
+        if (containers.length <= baseline) return;
+        const body = containers[containers.length - 1].querySelector(selector);
+        const text = body ? body[property] : '';
+        if (text && text !== last) {
+            last = text;
+            window.__qwenStreamDelta(text);
+        }
+    };
+    const observer = new MutationObserver(() => {
+        if (!scheduled) {
+            scheduled = true;
+            setTimeout(flush, 50);
+        }
+    });
+    observer.observe(document.body, {childList: true, subtree: true, characterData: true});
+    window.__qwenStreamObserver = observer;
+}
+"""
+
+STREAM_OBSERVER_STOP_JS = "() => { if (window.__qwenStreamObserver) { window.__qwenStreamObserver.disconnect(); window.__qwenStreamObserver = null; } }"
+
+async def stop_watching(page: Page):
+    """Stops reporting the output of the page's response."""
+    _stream_listeners.pop(page, None)
+    try:
+        await page.evaluate(STREAM_OBSERVER_STOP_JS)
+    except Exception:
+        pass
+
+def _on_stream_delta(source, text):
+    """Binding called from the page with the current text of the response being generated."""
+    listener = _stream_listeners.get(source["page"])
+    if listener:
+        listener(text)
+
+class _DeltaTracker:
+    """Turns successive full-text snapshots of a response into the new text since the last one."""
+    def __init__(self, on_delta):
+        self.on_delta = on_delta
+        self.sent = ""
+
+    def __call__(self, text: str):
+        if text == self.sent:
+            return
+        if text.startswith(self.sent):
+            self.on_delta({"text": text[len(self.sent):]})
+        else:
+            # The UI re-rendered earlier text (e.g. markdown reflow), so resend it whole.
+            self.on_delta({"text": text, "replace": True})
+        self.sent = text
+
+class _ProgressWatch:
+    """
+    Notes when the response being generated last changed, and the longest it has gone
+    without changing, passing each snapshot on to `on_text` if given.
+    """
+    def __init__(self, on_text=None):
+        self.on_text = on_text
+        self.last_change = time.monotonic()
+        self.longest_silence = 0.0
+
+    def __call__(self, text: str):
+        self.longest_silence = max(self.longest_silence, self.silence())
+        self.last_change = time.monotonic()
+        if self.on_text:
+            self.on_text(text)
+
+    def start(self):
+        """Starts the clock, when the prompt is submitted."""
+        self.last_change = time.monotonic()
+        self.longest_silence = 0.0
+
+    def silence(self) -> float:
+        """Seconds since the response last changed."""
+        return time.monotonic() - self.last_change
 
 # --- Browser and Page Management ---
+class PoolBusyError(Exception):
+    """
+    Raised when a request can't get a page in time: the wait queue is full, the
+    expected wait is longer than the request's deadline, or the deadline passed
+    while it was queued. Answered with `status` and a Retry-After header.
+    """
+    def __init__(self, message: str, status: int = 503, retry_after: float = 1):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+
+_page_ids = itertools.count(1)
+
+class PageSlot:
+    """Bookkeeping for one pooled page."""
+    def __init__(self, page: Page):
+        self.page = page
+        # Stable id for logs, unique across shards.
+        self.id = next(_page_ids)
+        # The chat the page is currently showing, so follow-ups can skip navigation.
+        self.chat_id: str = None
+        self.last_used = time.monotonic()
+        # When the current request got the page, to learn how long requests hold it.
+        self.acquired_at: float = None
+        # Requests served so far; used to decide when the page is due for recycling.
+        self.request_count = 0
+        # CDP session for reading the page's memory use, opened on first use.
+        self.cdp = None
+        # Set once a replacement is being opened; the page is closed instead of being reused.
+        self.retiring = False
+        # True while the page sits on an untouched "new chat" screen, ready to type into.
+        self.fresh = False
+        # Last model and web search state set on the page (None = not known). Both carry
+        # over to the next new chat in the same tab, so matching requests skip the clicks.
+        self.model_name: str = None
+        self.web_search: bool = None
+        # Model this page is kept on between requests (QWEN_POOL_MODEL_PINS), if any.
+        self.pinned_model: str = None
+
+class _Waiter:
+    """A request queued for a page."""
+    def __init__(self, chat_id: str, deadline: float = None, prefer_fresh: bool = True):
+        self.chat_id = chat_id
+        # False for work that doesn't start a chat and shouldn't use up a pre-warmed page.
+        self.prefer_fresh = prefer_fresh
+        # time.monotonic() after which the request is no longer worth serving.
+        self.deadline = deadline
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        # How many times a later request was served first because of chat affinity.
+        self.skips = 0
+
 class BrowserManager:
-    """Manages a persistent browser instance and a pool of pages for concurrent requests."""
-    def __init__(self, pool_size=3):
+    """
+    Manages a persistent browser instance and a pool of pages for concurrent requests.
+
+    Pages remember which chat they are showing. A request for a chat_id prefers the
+    page already on that chat; requests are otherwise served in arrival order, and a
+    waiting request can only be overtaken AFFINITY_MAX_SKIPS times.
+
+    After a release, up to PREWARM_PAGES idle pages are reset in the background to a
+    fresh "new chat" screen, so a new chat can be typed straight away.
+
+    The pool starts with `min_size` pages. A background task opens another page
+    (up to `max_size`) whenever a request has been queued longer than `grow_wait`
+    seconds, and closes pages that sat idle for `idle_timeout` seconds while the
+    pool is above `min_size`.
+
+    Admission is bounded: at most `max_queue` requests wait for a page, and a request
+    whose deadline can't be met (judging by recent page hold times) is turned away
+    with PoolBusyError instead of queueing until its client gives up.
+    """
+    def __init__(self, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, capture_mode=CAPTURE_MODE,
+                 grow_wait=POOL_GROW_WAIT, idle_timeout=POOL_IDLE_TIMEOUT, max_queue=MAX_QUEUE):
         self.playwright: Playwright = None
         self.browser: Browser = None
-        self.page_pool: asyncio.Queue = None
-        self.pool_size = pool_size
+        self.context: BrowserContext = None
+        self.slots: dict[Page, PageSlot] = {}
+        self.idle_slots: list[PageSlot] = []
+        self.waiters: list[_Waiter] = []
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.grow_wait = grow_wait
+        self.idle_timeout = idle_timeout
+        # Pages being opened right now, counted against max_size.
+        self.pending_pages = 0
+        # Pages being reset to a new chat screen; they are out of the idle list meanwhile.
+        self.warming_slots: set[PageSlot] = set()
+        # Recent queue wait times in seconds, for stats().
+        self.wait_times = deque(maxlen=500)
+        # Recent times requests held a page, to predict queue waits.
+        self.hold_times = deque(maxlen=200)
+        self.max_queue = max_queue
+        self.rejected_requests = 0
+        self.recycled_pages = 0
+        self.blocked_requests = 0
+        self._scaler_task: asyncio.Task = None
+        # "dom" or "network", see utils.CAPTURE_MODE.
+        self.capture_mode = capture_mode
+
+    @property
+    def pool_size(self) -> int:
+        return len(self.slots)
 
     async def initialize(self):
-        print("[*] Initializing browser manager...")
+        pool_log.info("Initializing browser manager...")
         if not STATE_FILE.exists():
             raise FileNotFoundError(
                 f"Authentication file not found at '{STATE_FILE}'. "
@@ -27,47 +258,637 @@ class BrowserManager:
             )
         
         self.playwright = await async_playwright().start()
-        print("[*] Launching persistent browser (this may take a moment)...")
+        pool_log.info("Launching persistent browser (this may take a moment)...")
         self.browser = await self.playwright.chromium.launch(headless=True)
         
-        context = await self.browser.new_context(storage_state=str(STATE_FILE))
+        self.context = await self.browser.new_context(storage_state=str(STATE_FILE))
         
-        print("[*] Applying stealth to browser context...")
-        await Stealth().apply_stealth_async(context)
+        pool_log.info("Applying stealth to browser context...")
+        await Stealth().apply_stealth_async(self.context)
+        await self.context.expose_binding("__qwenStreamDelta", _on_stream_delta)
+        if BLOCKED_URL_PATTERNS:
+            pool_log.info(f"Blocking {len(BLOCKED_URL_PATTERNS)} URL patterns in every page...")
+        if BLOCKED_RESOURCE_TYPES:
+            # Routing turns off the browser's HTTP cache, so the app's scripts and styles
+            # are downloaded again for every new tab; hence off by default.
+            pool_log.info(f"Blocking resource types {BLOCKED_RESOURCE_TYPES} (disables the HTTP cache)...")
+            await self.context.route("**/*", self._filter_request)
         
-        self.page_pool = asyncio.Queue(maxsize=self.pool_size)
-        for i in range(self.pool_size):
-            print(f"[*] Creating page {i+1}/{self.pool_size} for the pool...")
-            page = await context.new_page()
+        for i in range(self.min_size):
+            pool_log.info(f"Creating page {i+1}/{self.min_size} for the pool...")
+            self._hand_off(await self._open_slot())
+        self._scaler_task = asyncio.create_task(self._autoscale_loop())
+        self._schedule_prewarm()
+        pool_log.info(f"Browser and a pool of {self.pool_size} pages initialized successfully (max {self.max_size}).")
+
+    async def _filter_request(self, route):
+        """Aborts requests of the resource types the chat flow doesn't need (images, fonts, media)."""
+        request = route.request
+        if request.resource_type in BLOCKED_RESOURCE_TYPES and not any(
+            pattern in request.url for pattern in ALLOWED_URL_PATTERNS
+        ):
+            self.blocked_requests += 1
+            await route.abort()
+            return
+        await route.continue_()
+
+    async def _block_urls(self, page: Page):
+        """
+        Blocks BLOCKED_URL_PATTERNS in `page` through CDP. Unlike a Playwright route this
+        keeps the browser's HTTP cache, so new tabs load the app's assets from it.
+        """
+        def on_loading_failed(event):
+            if event.get("blockedReason") == "inspector":
+                self.blocked_requests += 1
+
+        session = await self.context.new_cdp_session(page)
+        session.on("Network.loadingFailed", on_loading_failed)
+        await session.send("Network.enable")
+        await session.send("Network.setBlockedURLs", {"urls": [f"*{pattern}*" for pattern in BLOCKED_URL_PATTERNS]})
+
+    async def _open_slot(self, pinned_model: str = None) -> PageSlot:
+        """
+        Opens a new tab on Qwen and registers it with the pool (but doesn't hand it out).
+        It takes `pinned_model`, or else any model pin still short of pages.
+        """
+        page = await self.context.new_page()
+        try:
+            if BLOCKED_URL_PATTERNS:
+                await self._block_urls(page)
             await page.goto(QWEN_URL, wait_until="domcontentloaded")
-            await self.page_pool.put(page)
-        print(f"[+] Browser and a pool of {self.pool_size} pages initialized successfully.")
+        except Exception:
+            await page.close()
+            raise
+        slot = PageSlot(page)
+        slot.pinned_model = pinned_model or self._model_to_pin()
+        self.slots[page] = slot
+        return slot
 
-    async def get_page(self) -> Page:
-        print("[*] Acquiring a page from the pool...")
-        page = await self.page_pool.get()
-        print("[+] Page acquired.")
-        return page
+    def _pinned_count(self, model_name: str) -> int:
+        """Pages pinned to `model_name`, not counting ones being retired."""
+        return sum(1 for s in self.slots.values() if s.pinned_model == model_name and not s.retiring)
+
+    def _model_to_pin(self) -> str:
+        """The first model in POOL_MODEL_PINS with fewer pinned pages than asked for, if any."""
+        for model_name, count in POOL_MODEL_PINS.items():
+            if self._pinned_count(model_name) < count:
+                return model_name
+        return None
+
+    def _restore_pins(self):
+        """Pins idle pages to models whose pinned pages were closed; pre-warming switches them over."""
+        for slot in self.idle_slots:
+            if slot.pinned_model is None and not slot.retiring:
+                slot.pinned_model = self._model_to_pin()
+                if slot.pinned_model is None:
+                    return
+
+    async def _grow(self):
+        self.pending_pages += 1
+        try:
+            slot = await self._open_slot()
+        except Exception as e:
+            pool_log.warning(f"Could not open an extra page for the pool: {e}")
+            return
+        finally:
+            self.pending_pages -= 1
+        pool_log.info(f"Pool grew to {self.pool_size} pages.")
+        self._hand_off(slot)
+
+    async def _close_slot(self, slot: PageSlot):
+        """Removes a page from the pool and closes it. The page must not be in use."""
+        if slot in self.idle_slots:
+            self.idle_slots.remove(slot)
+        self.slots.pop(slot.page, None)
+        if slot.pinned_model:
+            self._restore_pins()
+        try:
+            await slot.page.close()
+        except Exception as e:
+            pool_log.warning(f"Error closing page: {e}")
+
+    async def _reap_idle(self):
+        now = time.monotonic()
+        for slot in list(self.idle_slots):
+            if self.pool_size <= self.min_size:
+                break
+            if now - slot.last_used < self.idle_timeout:
+                continue
+            if slot.pinned_model and self._pinned_count(slot.pinned_model) <= POOL_MODEL_PINS.get(slot.pinned_model, 0):
+                # The pool's only pages on a pinned model stay open.
+                continue
+            await self._close_slot(slot)
+            pool_log.info(f"Closed an idle page, pool shrank to {self.pool_size} pages.")
+
+    async def _js_heap_mb(self, slot: PageSlot) -> float:
+        """Reads the page's used JS heap through CDP Performance.getMetrics."""
+        if slot.cdp is None:
+            slot.cdp = await self.context.new_cdp_session(slot.page)
+            await slot.cdp.send("Performance.enable")
+        result = await slot.cdp.send("Performance.getMetrics")
+        metrics = {m["name"]: m["value"] for m in result.get("metrics", [])}
+        return metrics.get("JSHeapUsedSize", 0) / (1024 * 1024)
+
+    async def _recycle_reason(self, slot: PageSlot) -> str:
+        """Returns why the page should be replaced, or None if it is still healthy."""
+        if RECYCLE_MAX_REQUESTS and slot.request_count >= RECYCLE_MAX_REQUESTS:
+            return f"served {slot.request_count} requests"
+        if RECYCLE_MAX_HEAP_MB and RECYCLE_CHECK_EVERY and slot.request_count % RECYCLE_CHECK_EVERY == 0:
+            heap_mb = await self._js_heap_mb(slot)
+            if heap_mb >= RECYCLE_MAX_HEAP_MB:
+                return f"JS heap at {heap_mb:.0f} MB"
+        return None
+
+    async def _maybe_recycle(self, slot: PageSlot):
+        """
+        Replaces a worn-out page. The replacement is opened and put into service before the
+        old page is closed, so the pool never has fewer usable pages than before.
+        """
+        bind(page_id=slot.id)
+        try:
+            reason = await self._recycle_reason(slot)
+        except Exception as e:
+            pool_log.warning(f"Could not check page health: {e}")
+            return
+        if not reason or slot.retiring or slot.page not in self.slots:
+            return
+
+        pool_log.info(f"Recycling a page ({reason})...")
+        slot.retiring = True
+        try:
+            replacement = await self._open_slot(slot.pinned_model)
+        except Exception as e:
+            pool_log.warning(f"Could not open a replacement page, keeping the old one: {e}")
+            slot.retiring = False
+            return
+        self._hand_off(replacement)
+        self.recycled_pages += 1
+        # If the old page is busy, release_page closes it when its request finishes.
+        if slot in self.idle_slots:
+            await self._close_slot(slot)
+        pool_log.info("Page recycled.")
+
+    async def _autoscale_loop(self):
+        """Grows the pool while requests queue up and shrinks it when pages go unused."""
+        while True:
+            await asyncio.sleep(POOL_SCALE_INTERVAL)
+            try:
+                now = time.monotonic()
+                # Each page already being opened will serve one of the oldest waiters.
+                starved = [w for w in self.waiters if now - w.enqueued_at >= self.grow_wait]
+                if len(starved) > self.pending_pages and self.pool_size + self.pending_pages < self.max_size:
+                    pool_log.info(f"A request has waited over {self.grow_wait}s for a page, growing the pool...")
+                    asyncio.create_task(self._grow())
+                elif not self.waiters:
+                    await self._reap_idle()
+            except Exception as e:
+                pool_log.warning(f"Pool autoscaler error: {e}")
+
+    def stats(self) -> dict:
+        """Current pool size and recent queue wait times."""
+        waits = list(self.wait_times)
+        now = time.monotonic()
+        return {
+            "size": self.pool_size,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "idle": len(self.idle_slots),
+            "busy": self.pool_size - len(self.idle_slots),
+            "opening": self.pending_pages,
+            "prewarmed": sum(1 for s in self.idle_slots if s.fresh),
+            "recycled": self.recycled_pages,
+            "blocked_requests": self.blocked_requests,
+            "queued": len(self.waiters),
+            "max_queue": self.max_queue,
+            "rejected": self.rejected_requests,
+            "expected_wait_ms": round(self.expected_wait() * 1000),
+            "oldest_queued_ms": round((now - self.waiters[0].enqueued_at) * 1000) if self.waiters else 0,
+            "wait_ms": {
+                "samples": len(waits),
+                "p50": round(percentile(waits, 50) * 1000),
+                "p95": round(percentile(waits, 95) * 1000),
+                "max": round(max(waits, default=0) * 1000),
+            },
+        }
+
+    def _pick_idle_slot(self, chat_id: str, model_name: str = None, prefer_fresh: bool = True) -> PageSlot:
+        """
+        Takes the idle page showing `chat_id`, or for a new chat one already set to
+        `model_name` (pre-warmed ones first) or else a pre-warmed one. Otherwise the least
+        recently used page, keeping pre-warmed and model-pinned pages for new chats.
+        With `prefer_fresh=False` (metadata loads) it goes straight to the latter.
+        """
+        slot = None
+        if chat_id:
+            slot = next((s for s in self.idle_slots if s.chat_id == chat_id), None)
+        elif prefer_fresh:
+            slot = (
+                next((s for s in self.idle_slots if s.fresh and s.model_name == model_name), None)
+                or (model_name and next((s for s in self.idle_slots if s.model_name == model_name), None))
+                or next((s for s in self.idle_slots if s.fresh and not s.pinned_model), None)
+                or next((s for s in self.idle_slots if s.fresh), None)
+            )
+        if slot is None:
+            slot = min(self.idle_slots, key=lambda s: (s.fresh, s.pinned_model is not None, s.last_used))
+        self.idle_slots.remove(slot)
+        return slot
+
+    @staticmethod
+    def _wants(waiter: _Waiter, slot: PageSlot) -> bool:
+        """Whether the page is already where the queued request needs it to be."""
+        if slot.chat_id:
+            return waiter.chat_id == slot.chat_id
+        return slot.fresh and waiter.chat_id is None and waiter.prefer_fresh
+
+    def _pick_waiter(self, slot: PageSlot) -> _Waiter:
+        """Chooses which queued request gets a freshly released page."""
+        head = self.waiters[0]
+        if not self._wants(head, slot) and head.skips < AFFINITY_MAX_SKIPS:
+            for waiter in self.waiters[1:AFFINITY_WINDOW]:
+                if self._wants(waiter, slot):
+                    for earlier in self.waiters[:self.waiters.index(waiter)]:
+                        earlier.skips += 1
+                    return waiter
+        return head
+
+    def expected_wait(self) -> float:
+        """Rough number of seconds a request arriving now would wait for a page."""
+        if self.idle_slots and not self.waiters:
+            return 0.0
+        hold = sum(self.hold_times) / len(self.hold_times) if self.hold_times else DEFAULT_HOLD_TIME
+        capacity = max(1, self.pool_size)
+        return (len(self.waiters) + 1) / capacity * hold
+
+    def _admit(self, deadline: float):
+        """Raises PoolBusyError if a new request can't be served in time."""
+        if len(self.waiters) >= self.max_queue:
+            self.rejected_requests += 1
+            raise PoolBusyError(f"Too many queued requests ({len(self.waiters)}).", 503, self.expected_wait())
+        if deadline is not None:
+            expected = self.expected_wait()
+            if time.monotonic() + expected > deadline:
+                self.rejected_requests += 1
+                raise PoolBusyError(f"Expected wait for a page ({expected:.0f}s) exceeds the request deadline.", 503, expected)
+
+    async def get_page(self, chat_id: str = None, deadline: float = None, model_name: str = None,
+                       prefer_fresh: bool = True) -> Page:
+        """
+        Waits for a free page, preferring one already showing `chat_id` or, for a new
+        chat, one already set to `model_name`.
+        `deadline` is a time.monotonic() value by which the request must have a page.
+        `prefer_fresh=False` leaves pre-warmed pages to new chats when others are idle.
+        """
+        pool_log.debug("Acquiring a page from the pool...", extra={"chat_id": chat_id})
+        if self.idle_slots and not self.waiters:
+            slot = self._pick_idle_slot(chat_id, model_name, prefer_fresh)
+            self.wait_times.append(0.0)
+            POOL_WAIT_SECONDS.observe(0.0)
+        else:
+            self._admit(deadline)
+            waiter = _Waiter(chat_id, deadline, prefer_fresh)
+            self.waiters.append(waiter)
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                slot = await asyncio.wait_for(waiter.future, timeout)
+            except asyncio.TimeoutError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                elif waiter.future.done() and not waiter.future.cancelled():
+                    # Handed a page just as the deadline passed; pass it on.
+                    self._hand_off(waiter.future.result())
+                self.rejected_requests += 1
+                raise PoolBusyError("Request deadline passed while waiting for a page.", 504, self.expected_wait())
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                elif waiter.future.done() and not waiter.future.cancelled():
+                    # We were handed a page just as we got cancelled; pass it on.
+                    self._hand_off(waiter.future.result())
+                raise
+            self.wait_times.append(time.monotonic() - waiter.enqueued_at)
+            POOL_WAIT_SECONDS.observe(self.wait_times[-1])
+        slot.acquired_at = time.monotonic()
+        hit = "showing the requested chat" if chat_id and slot.chat_id == chat_id else "from the pool"
+        bind(page_id=slot.id, chat_id=chat_id)
+        pool_log.debug(f"Page acquired ({hit}).", extra={"duration_ms": round(self.wait_times[-1] * 1000)})
+        return slot.page
+
+    def get_idle_page(self) -> Page:
+        """
+        Takes an idle page without waiting, for background work. Returns None if no
+        page is idle or requests are queued, so background work never delays them.
+        """
+        if not self.idle_slots or self.waiters:
+            return None
+        # Leave pre-warmed pages for new chats.
+        slot = min(self.idle_slots, key=lambda s: (s.fresh, s.last_used))
+        self.idle_slots.remove(slot)
+        slot.acquired_at = time.monotonic()
+        return slot.page
+
+    def _hand_off(self, slot: PageSlot):
+        """Gives a free page to the next queued request, or parks it as idle."""
+        slot.last_used = time.monotonic()
+        while self.waiters:
+            waiter = self._pick_waiter(slot)
+            self.waiters.remove(waiter)
+            if not waiter.future.done():
+                waiter.future.set_result(slot)
+                return
+        self.idle_slots.append(slot)
 
     def release_page(self, page: Page):
-        print("[*] Releasing page back to the pool...")
-        self.page_pool.put_nowait(page)
-        print("[+] Page released.")
+        slot = self.slots[page]
+        pool_log.debug("Releasing page back to the pool...", extra={"page_id": slot.id})
+        slot.chat_id = chat_id_from_url(page.url)
+        slot.request_count += 1
+        slot.fresh = False
+        if slot.acquired_at is not None:
+            self.hold_times.append(time.monotonic() - slot.acquired_at)
+            slot.acquired_at = None
+        if slot.retiring:
+            # Its replacement is already in service.
+            asyncio.create_task(self._close_slot(slot))
+            pool_log.debug("Page retired.")
+            return
+        self._hand_off(slot)
+        asyncio.create_task(self._maybe_recycle(slot))
+        self._schedule_prewarm()
+        pool_log.debug("Page released.")
+
+    def _schedule_prewarm(self):
+        """Resets idle pages to a new chat screen until PREWARM_PAGES of them are ready."""
+        ready = sum(1 for s in self.idle_slots if s.fresh) + len(self.warming_slots)
+        while ready < PREWARM_PAGES and not self.waiters:
+            candidates = [s for s in self.idle_slots if not s.fresh and not s.retiring]
+            if not candidates:
+                return
+            # Pinned pages moved off their model go first; otherwise the page least
+            # recently used is the one least likely to get a follow-up.
+            slot = min(candidates, key=lambda s: (s.model_name == s.pinned_model or s.pinned_model is None, s.last_used))
+            self.idle_slots.remove(slot)
+            self.warming_slots.add(slot)
+            asyncio.create_task(self._prewarm(slot))
+            ready += 1
+
+    async def _prewarm(self, slot: PageSlot):
+        bind(page_id=slot.id, chat_id=None)
+        page = slot.page
+        try:
+            pool_log.debug("Pre-warming a page to a new chat screen...")
+            await page.locator("#sidebar-new-chat-button").click()
+            await page.locator("textarea#chat-input").wait_for(timeout=15000)
+            await ensure_model(page, slot, slot.pinned_model or PREWARM_MODEL)
+            await ensure_web_search(page, slot, PREWARM_WEB_SEARCH)
+            slot.chat_id = None
+            slot.fresh = True
+            pool_log.debug("Page is ready for a new chat.")
+        except Exception as e:
+            slot.fresh = False
+            pool_log.warning(f"Could not pre-warm page: {e}")
+        finally:
+            self.warming_slots.discard(slot)
+            if slot.retiring:
+                # It was replaced while warming up.
+                await self._close_slot(slot)
+            elif slot.page in self.slots:
+                self._hand_off(slot)
+
+    def page_state(self, page: Page) -> PageSlot:
+        """The pool's bookkeeping for a page handed out by get_page."""
+        return self.slots[page]
 
     async def shutdown(self):
-        print("[*] Shutting down browser manager...")
+        pool_log.info("Shutting down browser manager...")
+        if self._scaler_task:
+            self._scaler_task.cancel()
         if self.browser:
             await self.browser.close()
         if self.playwright:
             await self.playwright.stop()
-        print("[+] Shutdown complete.")
+        pool_log.info("Shutdown complete.")
+
+class ShardedBrowserManager:
+    """
+    Spreads the load over several independent browsers, each with its own Playwright
+    driver process, Chromium instance and page pool, so more than one CPU core is used.
+
+    A chat stays on the shard it was started on (falling back to a hash of its id for
+    chats this process hasn't seen); new chats go to the least busy shard. It exposes
+    the same interface as BrowserManager, so handlers don't care which one they get.
+    """
+    # How many chat -> shard assignments to remember.
+    MAX_TRACKED_CHATS = 10000
+
+    def __init__(self, shard_count: int, **manager_kwargs):
+        self.shards = [BrowserManager(**manager_kwargs) for _ in range(shard_count)]
+        self.capture_mode = self.shards[0].capture_mode
+        self._page_shard: dict[Page, BrowserManager] = {}
+        self._chat_shard: OrderedDict[str, int] = OrderedDict()
+
+    async def initialize(self):
+        pool_log.info(f"Starting {len(self.shards)} browser shards...")
+        await asyncio.gather(*(shard.initialize() for shard in self.shards))
+        pool_log.info(f"All {len(self.shards)} browser shards are ready.")
+
+    def _shard_index(self, chat_id: str) -> int:
+        if chat_id:
+            if chat_id in self._chat_shard:
+                self._chat_shard.move_to_end(chat_id)
+                return self._chat_shard[chat_id]
+            return zlib.crc32(chat_id.encode()) % len(self.shards)
+        # New chat: the shard with the shortest queue, then the most idle pages.
+        return min(
+            range(len(self.shards)),
+            key=lambda i: (self.shards[i].expected_wait(), -len(self.shards[i].idle_slots)),
+        )
+
+    async def get_page(self, chat_id: str = None, deadline: float = None, model_name: str = None,
+                       prefer_fresh: bool = True) -> Page:
+        index = self._shard_index(chat_id)
+        page = await self.shards[index].get_page(chat_id, deadline, model_name, prefer_fresh)
+        self._page_shard[page] = self.shards[index]
+        return page
+
+    def get_idle_page(self) -> Page:
+        for shard in sorted(self.shards, key=lambda shard: -len(shard.idle_slots)):
+            page = shard.get_idle_page()
+            if page is not None:
+                self._page_shard[page] = shard
+                return page
+        return None
+
+    def page_state(self, page: Page) -> PageSlot:
+        return self._page_shard[page].page_state(page)
+
+    def release_page(self, page: Page):
+        shard = self._page_shard.pop(page)
+        shard.release_page(page)
+        chat_id = chat_id_from_url(page.url)
+        if chat_id:
+            self._chat_shard[chat_id] = self.shards.index(shard)
+            self._chat_shard.move_to_end(chat_id)
+            while len(self._chat_shard) > self.MAX_TRACKED_CHATS:
+                self._chat_shard.popitem(last=False)
+
+    def stats(self) -> dict:
+        shard_stats = [shard.stats() for shard in self.shards]
+        return {
+            "shards": shard_stats,
+            "size": sum(s["size"] for s in shard_stats),
+            "idle": sum(s["idle"] for s in shard_stats),
+            "busy": sum(s["busy"] for s in shard_stats),
+            "queued": sum(s["queued"] for s in shard_stats),
+            "rejected": sum(s["rejected"] for s in shard_stats),
+        }
+
+    async def shutdown(self):
+        await asyncio.gather(*(shard.shutdown() for shard in self.shards), return_exceptions=True)
+
+class ChatTurnLock:
+    """
+    Serializes requests for the same chat in arrival order, so two turns of one
+    conversation never type into it at once. Turns wait here, before asking the
+    pool for a page, so a queued turn doesn't hold a pool slot. Different chats
+    (and new chats) are not held up.
+    """
+    def __init__(self):
+        # chat_id -> futures of the turns for that chat; the first one holds the lock.
+        self._turns: dict[str, deque] = {}
+
+    async def acquire(self, chat_id: str, deadline: float = None):
+        if not chat_id:
+            return
+        turns = self._turns.setdefault(chat_id, deque())
+        turn = asyncio.get_running_loop().create_future()
+        turns.append(turn)
+        if len(turns) == 1:
+            turn.set_result(None)
+            return
+        pool_log.debug(f"Waiting for an earlier turn of chat {chat_id} to finish...")
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(asyncio.shield(turn), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if turn.done():
+                # Our turn came just as we gave up; pass it on.
+                self.release(chat_id)
+            else:
+                turns.remove(turn)
+            if isinstance(e, asyncio.TimeoutError):
+                raise PoolBusyError("Request deadline passed while an earlier turn of this chat was running.", 504)
+            raise
+
+    def release(self, chat_id: str):
+        if not chat_id:
+            return
+        turns = self._turns[chat_id]
+        turns.popleft()
+        if turns:
+            turns[0].set_result(None)
+        else:
+            del self._turns[chat_id]
+
+    def queued_chats(self) -> int:
+        """Number of chats with at least one turn waiting."""
+        return sum(1 for turns in self._turns.values() if len(turns) > 1)
 
 # --- Global Browser Manager Instance ---
-browser_manager = BrowserManager(pool_size=3)
+if BROWSER_SHARDS > 1:
+    browser_manager = ShardedBrowserManager(BROWSER_SHARDS)
+else:
+    browser_manager = BrowserManager()
+
+# Caches metadata lookups (/api/models, /api/model, /api/history) and shares in-flight ones.
+metadata_cache = MetadataCache(ttl=METADATA_TTL, max_stale=METADATA_MAX_STALE)
+
+# Opt-in cache of responses to repeatable new-chat prompts.
+response_cache = ResponseCache(
+    RESPONSE_CACHE_DIR,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_disk_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+)
+
+# Background chat and image jobs submitted through /api/jobs.
+job_manager = JobManager(concurrency=JOB_CONCURRENCY, retention=JOB_RETENTION, max_pending=JOB_MAX_PENDING)
+
+# Keeps turns of the same chat in order.
+chat_turns = ChatTurnLock()
+
+# Samples chat and image runs and keeps traces of the slow and failed ones.
+tracer = Tracer(
+    sample_rate=TRACE_SAMPLE_RATE,
+    slow_seconds=TRACE_SLOW_SECONDS,
+    max_events=TRACE_MAX_EVENTS,
+    directory=TRACE_DIR,
+    max_files=TRACE_MAX_FILES,
+)
+
+# Screenshots and HTML of pages that hit an error, written in the background.
+error_artifacts = ErrorArtifactStore(
+    ERROR_ARTIFACT_DIR,
+    max_bytes=int(ERROR_ARTIFACT_MAX_MB * 1024 * 1024),
+    per_minute=ERROR_ARTIFACT_PER_MINUTE,
+    burst=ERROR_ARTIFACT_BURST,
+    capture_timeout=ERROR_CAPTURE_TIMEOUT,
+)
+
+# Chat attachments, kept by content hash so files sent again are reused.
+upload_store = UploadStore(UPLOAD_DIR, max_bytes=int(UPLOAD_STORE_MAX_MB * 1024 * 1024))
+
+# Generated images, served from /api/images/<hash>.
+image_store = ImageStore(IMAGE_DIR, thumbnail_size=IMAGE_THUMBNAIL_SIZE, workers=IMAGE_THUMBNAIL_WORKERS)
+
+# Per-stage browser timeouts, learned from recent latency for each model/agent.
+stage_timeouts = StageTimeouts(
+    quantile=TIMEOUT_PERCENTILE,
+    margin=TIMEOUT_MARGIN,
+    min_samples=TIMEOUT_MIN_SAMPLES,
+    window=TIMEOUT_WINDOW,
+    limits=parse_timeout_limits(TIMEOUT_LIMITS),
+)
 
 # --- Quart App ---
 app = Quart(__name__)
 app = cors(app, allow_origin="*")
+# Leave room for the form fields around the largest allowed set of attachments.
+app.config["MAX_CONTENT_LENGTH"] = int((UPLOAD_MAX_TOTAL_MB + 1) * 1024 * 1024)
+
+@app.errorhandler(PoolBusyError)
+async def pool_busy_handler(error: PoolBusyError):
+    response = jsonify({"status": "error", "message": str(error)})
+    response.status_code = error.status
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+def request_deadline() -> float:
+    """
+    The time.monotonic() deadline for getting a page, from the X-Request-Deadline
+    header (seconds from now) or DEFAULT_DEADLINE.
+    """
+    try:
+        seconds = float(request.headers.get("X-Request-Deadline", DEFAULT_DEADLINE))
+    except ValueError:
+        seconds = DEFAULT_DEADLINE
+    return time.monotonic() + max(0.0, seconds)
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+    # A caller-supplied id lets a trace be matched to the caller's own logs.
+    request_id = request.headers.get("X-Request-Id", "")
+    if not (0 < len(request_id) <= 64 and request_id.replace("-", "").replace("_", "").isalnum()):
+        request_id = uuid.uuid4().hex
+    g.request_id = request_id
+    current_request_id.set(request_id)
+
+@app.after_request
+async def record_request_metrics(response):
+    if request.url_rule is not None and hasattr(g, "request_started"):
+        observe_request(request.url_rule.rule, request.method, response.status_code, time.perf_counter() - g.request_started)
+    if hasattr(g, "request_id"):
+        response.headers["X-Request-Id"] = g.request_id
+    return response
 
 @app.before_serving
 async def startup():
@@ -76,55 +897,86 @@ async def startup():
 @app.after_serving
 async def shutdown():
     await browser_manager.shutdown()
+    image_store.shutdown()
+    log_listener.stop()
 
 # --- Core Image Generation Logic ---
-async def generate_qwen_image(page: Page, prompt: str) -> dict:
+async def generate_qwen_image(page: Page, prompt: str, timeouts: dict = None, page_state: PageSlot = None) -> dict:
     """
     Uses a pre-existing browser page to generate an image from a prompt.
+    `timeouts` overrides the learned per-stage timeouts, in seconds per stage.
+    `page_state` is the pool's record of the page; image mode leaves its model and
+    web search setting unknown.
     """
+    budget = stage_timeouts.budget(timeout_key(agent_name="Image Generation"), timeouts)
+    watch = None
+    if page_state:
+        page_state.model_name = page_state.web_search = None
     try:
         # To get to the action buttons, we must be on a "new chat" screen.
         # If we are in an existing chat, click "New Chat".
         if "/c/" in page.url:
-            print("[*] Currently in a chat, clicking 'New Chat' to access action buttons...")
-            await page.locator("#sidebar-new-chat-button").click()
-            # Wait for the URL to change to a new chat, which indicates the page has reset.
-            try:
-                await page.wait_for_url(f"{QWEN_URL}c/*", timeout=15000)
-            except Exception as e:
-                print(f"[!] Error waiting for new chat URL: {e}")
-                await save_error_state(page)
+            with stage_timer("new_chat", budget):
+                browser_log.debug("Currently in a chat, clicking 'New Chat' to access action buttons...")
+                await page.locator("#sidebar-new-chat-button").click()
+                # Wait for the URL to change to a new chat, which indicates the page has reset.
+                try:
+                    await page.wait_for_url(f"{QWEN_URL}c/*", timeout=budget.ms("new_chat"))
+                except Exception as e:
+                    browser_log.warning(f"Error waiting for new chat URL: {e}")
+                    await error_artifacts.capture(page, "image")
 
-        print("[*] Clicking 'Image Generation' action button...")
-        action_buttons_container = page.locator('div.chat-recommend-txt-container')
-        image_gen_button = action_buttons_container.locator('button:has-text("Image Generation")')
-        await image_gen_button.wait_for(timeout=15000)
-        await image_gen_button.click()
+        with stage_timer("image_button", budget):
+            browser_log.debug("Clicking 'Image Generation' action button...")
+            action_buttons_container = page.locator('div.chat-recommend-txt-container')
+            image_gen_button = action_buttons_container.locator('button:has-text("Image Generation")')
+            await image_gen_button.wait_for(timeout=budget.ms("image_button"))
+            await image_gen_button.click()
 
-        chat_input = page.locator("textarea#chat-input")
-        await chat_input.wait_for(timeout=30000)
-        
-        print(f"[*] Filling image prompt: \"{prompt}\"")
-        await chat_input.fill(prompt)
-        await chat_input.press('Enter')
+        with stage_timer("submit", budget):
+            chat_input = page.locator("textarea#chat-input")
+            await chat_input.wait_for(timeout=budget.ms("submit"))
 
-        print("[*] Waiting for the image to be generated...")
-        last_response_container = page.locator('.response-meesage-container').last
-        
-        # Wait for an image tag with a blob or http src to be present.
-        generated_image = last_response_container.locator("#response-content-container img[src^='blob'], #response-content-container img[src^='http']:not([src*='image_generating.png'])")
-        await generated_image.wait_for(state="visible", timeout=120000)
+            browser_log.debug(f"Filling image prompt: \"{prompt}\"")
+            await chat_input.fill(prompt)
+            baseline = await page.locator('.response-meesage-container').count()
+            watch = _stream_listeners[page] = _ProgressWatch()
+            await page.evaluate(STREAM_OBSERVER_JS, [baseline, '#response-content-container', 'innerHTML'])
+            watch.start()
+            await chat_input.press('Enter')
+
+        with stage_timer("image", budget):
+            browser_log.debug("Waiting for the image to be generated...")
+            last_response_container = page.locator('.response-meesage-container').last
+
+            # Wait for an image tag with a blob or http src to be present.
+            generated_image = last_response_container.locator("#response-content-container img[src^='blob'], #response-content-container img[src^='http']:not([src*='image_generating.png'])")
+            await wait_unless_stalled(generated_image.wait_for(state="visible", timeout=budget.ms("image")), watch, budget)
         
         image_url = await generated_image.get_attribute("src")
-        print(f"[+] Image generated successfully: {image_url}")
-
+        browser_log.info(f"Image generated successfully: {image_url}")
         current_chat_id = page.url.split('/c/')[1].split('?')[0]
-        return {"status": "success", "image_url": image_url, "chat_id": current_chat_id}
+        result = {"status": "success", "image_url": image_url, "chat_id": current_chat_id}
+
+        # blob: URLs only resolve inside the pooled page, so keep a copy clients can fetch.
+        try:
+            data, content_type = await image_store.read_from_page(page, generated_image)
+            image_id = await image_store.put(data, content_type)
+        except Exception as e:
+            browser_log.warning(f"Could not save the generated image, returning its page URL: {e}")
+            return result
+        result.update(image_id=image_id, image_url=f"/api/images/{image_id}", source_url=image_url)
+        if image_store.thumbnail_size:
+            result["thumbnail_url"] = f"/api/images/{image_id}/thumbnail"
+        return result
 
     except Exception as e:
-        print(f"\n[!] An error occurred during image generation: {e}")
-        await save_error_state(page)
+        browser_log.error(f"An error occurred during image generation: {e}")
+        await error_artifacts.capture(page, "image")
         return {"status": "error", "message": str(e)}
+    finally:
+        if watch:
+            await stop_watching(page)
 
 # --- Core Model Fetching Logic ---
 async def get_available_models(page: Page) -> dict:
@@ -132,7 +984,7 @@ async def get_available_models(page: Page) -> dict:
     Clicks the model selector and scrapes the list of available models.
     """
     try:
-        print("[*] Fetching available models...")
+        browser_log.debug("Fetching available models...")
         model_selector_button = page.locator('#model-selector-button')
         await model_selector_button.click()
 
@@ -140,187 +992,649 @@ async def get_available_models(page: Page) -> dict:
         dropdown_menu = page.locator('div[role="menu"]')
         await dropdown_menu.wait_for(state="visible", timeout=10000)
 
-        model_items = dropdown_menu.locator('a[role="menuitem"]')
-        count = await model_items.count()
-        models = [await model_items.nth(i).inner_text() for i in range(count)]
-        
-        print(f"[+] Found {len(models)} models: {models}")
+        models = await extract_texts(dropdown_menu.locator('a[role="menuitem"]'))
+
+        browser_log.info(f"Found {len(models)} models: {models}")
         # Click somewhere to close the dropdown
         await page.locator('body').click()
         return {"status": "success", "models": models}
     except Exception as e:
-        print(f"\n[!] An error occurred while fetching models: {e}")
-        await save_error_state(page)
+        browser_log.error(f"An error occurred while fetching models: {e}")
+        await error_artifacts.capture(page, "models")
+        return {"status": "error", "message": str(e)}
+
+# --- Core History Fetching Logic ---
+async def get_chat_history(page: Page) -> dict:
+    """
+    Scrapes the chat sessions listed in the sidebar. If the sidebar didn't show any
+    chats in time, the result is marked "partial": the list may just not have loaded.
+    """
+    try:
+        browser_log.debug("Fetching chat history...")
+        # Ensure we are on a page where the sidebar is visible by navigating to the base URL
+        if "/c/" not in page.url:
+            await page.goto(QWEN_URL, wait_until="networkidle")
+
+        history_items_selector = 'div.session-list a.chat-item-drag-link'
+        history_items = page.locator(history_items_selector)
+        partial = False
+        try:
+            await history_items.first.wait_for(state="visible", timeout=15000)
+        except Exception as e:
+            browser_log.warning(f"Error waiting for history items: {e}")
+            await error_artifacts.capture(page, "history")
+            partial = True
+
+        history = await extract_history(page, history_items_selector)
+
+        browser_log.info(f"Found {len(history)} chat sessions.")
+        result = {"status": "success", "history": history}
+        if partial:
+            result["partial"] = True
+        return result
+    except Exception as e:
+        browser_log.error(f"An error occurred while fetching history: {e}")
+        await error_artifacts.capture(page, "history")
+        return {"status": "error", "message": str(e)}
+
+# --- Core Current Model Logic ---
+async def get_current_model(page: Page) -> dict:
+    """
+    Reads the name of the currently selected model.
+    """
+    try:
+        browser_log.debug("Fetching model information...")
+        model_selector_button = page.locator('div[class*="no-translate"] button')
+        await model_selector_button.wait_for(state="visible", timeout=15000)
+        model_name = await model_selector_button.inner_text()
+        return {"status": "success", "model_name": model_name.strip()}
+    except Exception as e:
+        browser_log.error(f"An error occurred while fetching model info: {e}")
+        await error_artifacts.capture(page, "model")
         return {"status": "error", "message": str(e)}
 
+# --- Network Capture ---
+def is_completion_response(response) -> bool:
+    """Matches the POST the Qwen web app streams its reply over."""
+    return response.request.method == "POST" and COMPLETION_URL_FRAGMENT in response.url
+
+class IncompleteCompletionError(Exception):
+    """Raised when a completion stream ends without signalling that the reply finished."""
+
+class ResponseStalledError(Exception):
+    """Raised when a reply or image shows no new output for longer than its "stall" timeout."""
+
+async def wait_unless_stalled(awaitable, watch: _ProgressWatch, budget: TimeoutBudget):
+    """
+    Awaits `awaitable`, giving up with ResponseStalledError once `watch` has seen no new
+    output for the learned "stall" timeout. The awaitable's own timeout still bounds the
+    wait as a whole. The longest silence of a finished wait feeds the "stall" timeout.
+    """
+    stall = budget.ms("stall") / 1000
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            left = stall - watch.silence()
+            if left <= 0:
+                raise ResponseStalledError(f"The response showed no new output for {stall:g}s")
+            done, _ = await asyncio.wait({task}, timeout=left)
+            if done:
+                result = task.result()
+                budget.record("stall", max(watch.longest_silence, watch.silence()))
+                return result
+    except ResponseStalledError as e:
+        budget.record("stall", watch.silence(), e)
+        raise
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+async def read_completion_response(response, timeout: float) -> dict:
+    """
+    Waits up to `timeout` seconds for a completion stream to end and extracts the reply.
+    Returns None if the payload couldn't be used, so the caller can fall back to the DOM.
+    Raises asyncio.TimeoutError if the stream doesn't end in time, and
+    IncompleteCompletionError if it ends without finishing (an aborted or failed
+    generation), as the page has nothing more complete to offer in either case.
+    """
+    if not response.ok:
+        browser_log.warning(f"Completion request failed with HTTP {response.status}.")
+        return None
+    try:
+        body = await asyncio.wait_for(response.text(), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise asyncio.TimeoutError(f"Completion stream did not finish within {timeout:g}s")
+    captured = parse_completion_stream(body)
+    if not captured["finished"]:
+        raise IncompleteCompletionError(f"Completion stream ended before the reply finished ({len(captured['text'])} characters received).")
+    if not captured["text"]:
+        browser_log.warning("Completion stream contained no answer text.")
+        return None
+    if not captured["chat_id"]:
+        captured["chat_id"] = parse_qs(urlparse(response.url).query).get("chat_id", [None])[0]
+    return captured
+
+# --- Chat Settings ---
+async def select_model(page: Page, model_name: str, timeout: float = 10000):
+    """Picks a model from the model selector dropdown."""
+    model_selector_button = page.locator('#model-selector-button')
+    await model_selector_button.click()
+    dropdown_menu = page.locator('div[role="menu"]')
+    await dropdown_menu.wait_for(state="visible", timeout=timeout)
+    await dropdown_menu.locator(f'a:has-text("{model_name}")').click()
+    await dropdown_menu.wait_for(state="hidden", timeout=timeout / 2)
+
+async def set_web_search(page: Page, enabled: bool, timeout: float = 10000) -> bool:
+    """Turns the web search toggle on or off and returns the resulting state."""
+    search_button = page.locator('button.websearch_button')
+    await search_button.wait_for(state="visible", timeout=timeout)
+    is_search_active = await search_button.get_attribute('aria-pressed') == 'true'
+
+    if enabled and not is_search_active:
+        browser_log.debug("Web search requested and is not active. Clicking to enable.")
+        await search_button.click()
+    elif not enabled and is_search_active:
+        browser_log.debug("Web search is not requested and is active. Clicking to disable.")
+        await search_button.click()
+    else:
+        browser_log.debug(f"Web search state is already as requested (active: {is_search_active}).")
+    return enabled
+
+async def ensure_model(page: Page, state: PageSlot, model_name: str, budget: TimeoutBudget = None) -> bool:
+    """
+    Selects `model_name` unless `state` says the page already has it.
+    Returns whether the UI had to be touched. With a `budget` the switch is timed as
+    the "model_switch" stage and uses its learned timeout.
+    """
+    if not model_name:
+        return False
+    if state and state.model_name == model_name:
+        UI_TOGGLES.labels("model", "skipped").inc()
+        return False
+    if state:
+        # Unknown until the switch has gone through.
+        state.model_name = None
+    if budget is None:
+        await select_model(page, model_name)
+    else:
+        with stage_timer("model_switch", budget):
+            await select_model(page, model_name, budget.ms("model_switch"))
+    UI_TOGGLES.labels("model", "changed").inc()
+    if state:
+        state.model_name = model_name
+    return True
+
+async def ensure_web_search(page: Page, state: PageSlot, enabled: bool, budget: TimeoutBudget = None) -> bool:
+    """
+    Sets the web search toggle unless `state` says it is already as requested.
+    Returns whether the UI had to be touched. With a `budget` the change is timed as
+    the "web_search" stage and uses its learned timeout.
+    """
+    enabled = bool(enabled)
+    if state and state.web_search == enabled:
+        UI_TOGGLES.labels("web_search", "skipped").inc()
+        return False
+    if state:
+        state.web_search = None
+    if budget is None:
+        await set_web_search(page, enabled)
+    else:
+        with stage_timer("web_search", budget):
+            await set_web_search(page, enabled, budget.ms("web_search"))
+    UI_TOGGLES.labels("web_search", "changed").inc()
+    if state:
+        state.web_search = enabled
+    return True
+
 # --- Core Chat Logic ---
-async def ask_qwen(page: Page, prompt: str, chat_id: str = None, use_web_search: bool = False, file_paths: list = None, agent_name: str = None, model_name: str = None) -> dict:
+async def ask_qwen(page: Page, prompt: str, chat_id: str = None, use_web_search: bool = False, files: list = None, agent_name: str = None, model_name: str = None, on_delta=None, capture_mode: str = "dom", page_state: PageSlot = None, timeouts: dict = None) -> dict:
     """
     Uses a pre-existing browser page to send a prompt to Qwen and return the response.
+    If `on_delta` is given, it is called with {"text": ...} events as the response is generated.
+    With capture_mode="network" the reply is read from the completion stream instead of the
+    rendered page, falling back to the DOM if the stream can't be read.
+    `page_state` is the pool's record of the page: if it is a pre-warmed new chat screen
+    the new chat click is skipped, and the model and web search toggle are only touched
+    when the page isn't known to be in the requested state already.
+    Browser waits use the timeouts learned for the model and agent (see timeouts.py);
+    `timeouts` overrides them, in seconds per stage.
     """
+    budget = stage_timeouts.budget(timeout_key(model_name, agent_name), timeouts)
+    tracker = _DeltaTracker(on_delta) if on_delta else None
+    watch = None
+    fresh = bool(page_state and page_state.fresh)
+    if page_state:
+        page_state.fresh = False
     try:
         if chat_id:
             # We have a specific chat to continue
             target_url = f"{QWEN_URL}c/{chat_id}"
             # Navigate only if we are not already on the correct chat page
             if not page.url.startswith(target_url):
-                print(f"[*] Navigating to existing chat: {target_url}")
-                await page.goto(target_url, wait_until="networkidle")
+                with stage_timer("navigation", budget):
+                    browser_log.debug(f"Navigating to existing chat: {target_url}")
+                    if page_state:
+                        # A reload loads the chat's own settings.
+                        page_state.model_name = page_state.web_search = None
+                    await page.goto(target_url, wait_until="networkidle", timeout=budget.ms("navigation"))
         else:
             # We want a new chat.
             # If we are currently in an old chat, click the "New Chat" button to start fresh.
-            if "/c/" in page.url or QWEN_URL in page.url:
-                print("[*] Currently in a chat, clicking 'New Chat' to start a new one...")
-                await page.locator("#sidebar-new-chat-button").click()
-                # The click should navigate to a new chat URL. We wait for that to happen.
-                try:
-                    await page.wait_for_url(f"{QWEN_URL}c/*", wait_until="load", timeout=15000)
-                except Exception as e:
-                    print(f"[!] Error waiting for new chat URL: {e}")
-                    await save_error_state(page)
+            if fresh:
+                browser_log.debug("Page is already on a pre-warmed new chat screen.")
+            elif "/c/" in page.url or QWEN_URL in page.url:
+                with stage_timer("new_chat", budget):
+                    browser_log.debug("Currently in a chat, clicking 'New Chat' to start a new one...")
+                    await page.locator("#sidebar-new-chat-button").click()
+                    # The click should navigate to a new chat URL. We wait for that to happen.
+                    try:
+                        await page.wait_for_url(f"{QWEN_URL}c/*", wait_until="load", timeout=budget.ms("new_chat"))
+                    except Exception as e:
+                        browser_log.warning(f"Error waiting for new chat URL: {e}")
+                        await error_artifacts.capture(page, "chat")
             else:
                 # We are on the homepage, ready for a new chat.
-                print("[*] On homepage, will start a new chat directly.")
+                browser_log.debug("On homepage, will start a new chat directly.")
 
             # Handle Model Selection
             if model_name:
-                print(f"[*] Switching to model: {model_name}")
                 try:
-                    model_selector_button = page.locator('#model-selector-button')
-                    await model_selector_button.click()
-                    dropdown_menu = page.locator('div[role="menu"]')
-                    await dropdown_menu.wait_for(state="visible", timeout=10000)
-                    await dropdown_menu.locator(f'a:has-text("{model_name}")').click()
-                    await dropdown_menu.wait_for(state="hidden", timeout=5000)
-                    print(f"[+] Switched to model '{model_name}' successfully.")
+                    if await ensure_model(page, page_state, model_name, budget):
+                        browser_log.debug(f"Switched to model '{model_name}' successfully.")
+                    else:
+                        browser_log.debug(f"Page already uses model '{model_name}'.")
                 except Exception as e:
-                    print(f"[!] Could not switch model to '{model_name}'. Error: {e}")
+                    browser_log.warning(f"Could not switch model to '{model_name}'. Error: {e}")
 
             # Handle Agent Activation
             if agent_name:
-                print(f"[*] Activating agent: {agent_name}")
-                try:
-                    action_buttons_container = page.locator('div.chat-recommend-txt-container')
-                    agent_button = action_buttons_container.locator(f'button:has-text("{agent_name}")')
-                    await agent_button.click(timeout=10000)
-                except Exception as e:
-                    print(f"[!] Could not activate agent '{agent_name}'. It might not be available on the page. Error: {e}")
+                browser_log.debug(f"Activating agent: {agent_name}")
+                if page_state:
+                    # An agent sets its own model and tools.
+                    page_state.model_name = page_state.web_search = None
+                with stage_timer("agent", budget):
+                    try:
+                        action_buttons_container = page.locator('div.chat-recommend-txt-container')
+                        agent_button = action_buttons_container.locator(f'button:has-text("{agent_name}")')
+                        await agent_button.click(timeout=budget.ms("agent"))
+                    except Exception as e:
+                        browser_log.warning(f"Could not activate agent '{agent_name}'. It might not be available on the page. Error: {e}")
 
             # Handle Web Search Toggle - This should only be done for new chats.
             try:
-                search_button = page.locator('button.websearch_button')
-                await search_button.wait_for(state="visible", timeout=10000)
-                is_search_active = await search_button.get_attribute('aria-pressed') == 'true'
-
-                if use_web_search and not is_search_active:
-                    print("[*] Web search requested and is not active. Clicking to enable.")
-                    await search_button.click()
-                elif not use_web_search and is_search_active:
-                    print("[*] Web search is not requested and is active. Clicking to disable.")
-                    await search_button.click()
-                else:
-                    print(f"[*] Web search state is already as requested (active: {is_search_active}).")
+                if not await ensure_web_search(page, page_state, use_web_search, budget):
+                    browser_log.debug(f"Page already has web search {'on' if use_web_search else 'off'}.")
             except Exception as e:
-                print(f"[!] Could not toggle web search (button might not be present): {e}")
+                browser_log.warning(f"Could not toggle web search (button might not be present): {e}")
 
         # Handle file attachments
-        if file_paths:
-            print(f"[*] Attaching {len(file_paths)} file(s)...")
-            # The Qwen UI has a hidden file input that is used for uploads.
-            file_input_selector = 'input#filesUpload'
-            # We need to make sure the file chooser is ready, which can be done by clicking the attachment button.
-            await page.locator('button.chat-prompt-upload-group-btn').click()
-            await page.locator(file_input_selector).set_input_files(file_paths)
-            # Wait for the UI to show the attachment.
-            await page.locator('div[class*="_fileItem_"]').first.wait_for(state="visible", timeout=30000)
-            print("[+] Files attached successfully.")
-
-        chat_input = page.locator("textarea#chat-input")
-        await chat_input.wait_for(timeout=30000)
-        if prompt:
-            await chat_input.fill(prompt)
-        await chat_input.press('Enter')
-        
-        print("[*] Waiting for the new response to finish generating...")
-        # Waiting for the "Thinking" button to disappear can be unreliable.
-        # A better approach is to wait for the response controls (like the regenerate button)
-        # to appear in the last message bubble, which confirms the response is fully rendered.
-        last_response_container = page.locator('.response-meesage-container').last
-        regenerate_button = last_response_container.locator("button.regenerate-response-button")
-        await regenerate_button.wait_for(state="visible", timeout=90000)
-        print("[+] Response finished.")
-        
-        response_text = await last_response_container.locator('.markdown-content-container').inner_text()
+        if files:
+            browser_log.debug(f"Attaching {len(files)} file(s)...")
+            with stage_timer("file_upload", budget):
+                # The Qwen UI has a hidden file input that is used for uploads.
+                file_input_selector = 'input#filesUpload'
+                # We need to make sure the file chooser is ready, which can be done by clicking the attachment button.
+                await page.locator('button.chat-prompt-upload-group-btn').click()
+                await page.locator(file_input_selector).set_input_files(await upload_store.input_files(files))
+                # Wait for the UI to show the attachment.
+                await page.locator('div[class*="_fileItem_"]').first.wait_for(state="visible", timeout=budget.ms("file_upload"))
+            browser_log.debug("Files attached successfully.")
+
+        with stage_timer("submit", budget):
+            chat_input = page.locator("textarea#chat-input")
+            await chat_input.wait_for(timeout=budget.ms("submit"))
+            if prompt:
+                await chat_input.fill(prompt)
+
+            # Start watching before submitting so the first tokens aren't missed. The
+            # watch also tells a slow reply from a stuck page.
+            baseline = await page.locator('.response-meesage-container').count()
+            watch = _stream_listeners[page] = _ProgressWatch(tracker)
+            await page.evaluate(STREAM_OBSERVER_JS, [baseline, '.markdown-content-container', 'innerText'])
+
+        with stage_timer("completion", budget):
+            completion_timeout = budget.ms("completion")
+            completion_started = time.monotonic()
+            captured = None
+            watch.start()
+            if capture_mode == "network":
+                browser_log.debug("Waiting for the completion stream to finish...")
+                async with page.expect_response(is_completion_response, timeout=min(30000, completion_timeout)) as response_info:
+                    await chat_input.press('Enter')
+                try:
+                    captured = await wait_unless_stalled(
+                        read_completion_response(await response_info.value, completion_timeout / 1000), watch, budget)
+                except (asyncio.TimeoutError, IncompleteCompletionError, ResponseStalledError):
+                    # The page is showing the same stuck or cut-off reply; waiting on it won't help.
+                    raise
+                except Exception as e:
+                    browser_log.warning(f"Could not read the completion stream, falling back to the page: {e}")
+            else:
+                await chat_input.press('Enter')
+
+            if captured:
+                browser_log.debug("Completion stream finished.")
+                response_text = captured["text"]
+                code_blocks = code_blocks_from_markdown(response_text)
+            else:
+                browser_log.debug("Waiting for the new response to finish generating...")
+                # Waiting for the "Thinking" button to disappear can be unreliable.
+                # A better approach is to wait for the response controls (like the regenerate button)
+                # to appear in the last message bubble, which confirms the response is fully rendered.
+                last_response_container = page.locator('.response-meesage-container').last
+                regenerate_button = last_response_container.locator("button.regenerate-response-button")
+                # A fallback from network capture only gets what is left of the stage's timeout.
+                remaining = completion_timeout - (time.monotonic() - completion_started) * 1000
+                await wait_unless_stalled(regenerate_button.wait_for(state="visible", timeout=max(1, remaining)), watch, budget)
+                browser_log.debug("Response finished.")
+                
+                extracted = await extract_response(last_response_container.locator('.markdown-content-container'))
+                response_text = extracted["text"]
+                code_blocks = extracted["code_blocks"]
+        if tracker:
+            # Flush anything the observer hadn't reported yet.
+            tracker(response_text)
         
-        # Extract the new or existing chat_id from the URL
-        current_chat_id = page.url.split('/c/')[1].split('?')[0]
-        print(f"[+] Response received for chat_id: {current_chat_id}")
-        return {"status": "success", "response": response_text, "chat_id": current_chat_id}
+        # Extract the new or existing chat_id from the stream or the URL
+        current_chat_id = (captured and captured["chat_id"]) or chat_id_from_url(page.url)
+        browser_log.info("Response received.", extra={"chat_id": current_chat_id})
+        return {"status": "success", "response": response_text, "code_blocks": code_blocks, "chat_id": current_chat_id}
 
     except Exception as e:
-        print(f"\n[!] An error occurred during automation: {e}")
-        await save_error_state(page)
+        browser_log.error(f"An error occurred during automation: {e}")
+        await error_artifacts.capture(page, "chat")
         return {"status": "error", "message": str(e)}
     finally:
-        # Clean up any temporary files that were uploaded
-        if file_paths:
-            for path in file_paths:
-                try:
-                    os.remove(path)
-                    print(f"[*] Cleaned up temporary file: {path}")
-                except OSError as e:
-                    print(f"[!] Error cleaning up file {path}: {e}")
+        if watch:
+            await stop_watching(page)
 
 # --- API Endpoints ---
-@app.route('/api/chat', methods=['POST'])
-async def chat_handler():
+async def parse_chat_request():
+    """
+    Reads the chat parameters from a JSON or multipart/form-data request.
+    Returns a tuple of (params, error_response); exactly one of them is None.
+    """
     # Handle both JSON and multipart/form-data requests
     if 'multipart/form-data' in request.content_type:
-        form = await request.form
-        files = await request.files
+        # Parsed as it streams in; attachments are stored by content hash.
+        try:
+            form, files = await upload_store.read_multipart(
+                request,
+                max_file_bytes=int(UPLOAD_MAX_FILE_MB * 1024 * 1024),
+                max_total_bytes=int(UPLOAD_MAX_TOTAL_MB * 1024 * 1024),
+                max_files=UPLOAD_MAX_FILES,
+                memory_limit=int(UPLOAD_MEMORY_LIMIT_KB * 1024),
+            )
+        except UploadTooLargeError as e:
+            return None, (jsonify({"status": "error", "message": str(e)}), 413)
+        except ValueError as e:
+            return None, (jsonify({"status": "error", "message": str(e)}), 400)
         prompt = form.get('prompt', '')
         chat_id = form.get('chat_id')
         use_web_search = form.get('use_web_search', 'false').lower() == 'true'
         agent_name = form.get('agent_name')
         model_name = form.get('model_name')
-        
-        uploaded_files = files.getlist('files')
-        file_paths = []
-        if uploaded_files:
-            # Create a temporary directory for uploads if it doesn't exist
-            temp_dir = Path(current_app.root_path) / "temp_uploads"
-            temp_dir.mkdir(exist_ok=True)
-            
-            for file in uploaded_files:
-                # Use a unique filename to avoid collisions
-                filename = f"{uuid.uuid4()}_{file.filename}"
-                path = temp_dir / filename
-                await file.save(path)
-                file_paths.append(str(path))
+        timeouts = form.get('timeouts')
+        if timeouts:
+            # A number of seconds, or a JSON object of stage -> seconds.
+            try:
+                timeouts = json.loads(timeouts)
+            except ValueError:
+                release_uploads(files)
+                return None, (jsonify({"status": "error", "message": "'timeouts' must be a number or a JSON object"}), 400)
     else:
         # Original JSON handling for requests without files
         data = await request.get_json()
         if not data or 'prompt' not in data:
-            return jsonify({"status": "error", "message": "Missing 'prompt' in request body"}), 400
+            return None, (jsonify({"status": "error", "message": "Missing 'prompt' in request body"}), 400)
         prompt = data['prompt']
         chat_id = data.get('chat_id')
         use_web_search = data.get('use_web_search', False)
         agent_name = data.get('agent_name')
         model_name = data.get('model_name')
-        file_paths = None
+        timeouts = data.get('timeouts')
+        files = None
+
+    if not prompt and not files:
+        return None, (jsonify({"status": "error", "message": "Request must contain a 'prompt' or files"}), 400)
+    try:
+        timeouts = parse_timeout_overrides(timeouts, "completion")
+    except ValueError as e:
+        release_uploads(files)
+        return None, (jsonify({"status": "error", "message": str(e)}), 400)
 
-    if not prompt and not file_paths:
-        return jsonify({"status": "error", "message": "Request must contain a 'prompt' or files"}), 400
+    log.info(f"Received request for chat_id: {chat_id}, prompt: \"{prompt[:50]}...\", agent: {agent_name}, model: {model_name}, files: {len(files) if files else 0}")
+    params = {
+        "prompt": prompt,
+        "chat_id": chat_id,
+        "use_web_search": use_web_search,
+        "files": files,
+        "agent_name": agent_name,
+        "model_name": model_name,
+        "timeouts": timeouts,
+    }
+    return params, None
 
-    print(f"[*] Received request for chat_id: {chat_id}, prompt: \"{prompt[:50]}...\", agent: {agent_name}, model: {model_name}, files: {len(file_paths) if file_paths else 0}")
+def sse_event(event: str, data: dict) -> str:
+    """Formats a single Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def response_cache_key(params: dict) -> str:
+    """
+    Returns the response cache key for a chat request, or None if the request
+    may not be answered from the cache: caching is off, the client sent
+    Cache-Control: no-cache/no-store, it continues a chat, or it uses web search.
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    cache_control = request.headers.get("Cache-Control", "").lower()
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return None
+    if params["chat_id"] or params["use_web_search"]:
+        return None
+    file_hashes = [upload.sha256 for upload in params["files"] or []]
+    return ResponseCache.make_key(params["prompt"], params["model_name"], params["agent_name"], file_hashes)
+
+def release_uploads(files: list):
+    """Lets the upload store evict a request's attachments again once it is done with them."""
+    upload_store.release(files)
+
+def note_new_chat(requested_chat_id: str, result: dict):
+    """Drops the cached chat history when a request started a new chat."""
+    if result.get("status") == "success" and result.get("chat_id") != requested_chat_id:
+        metadata_cache.invalidate("history")
+
+async def run_chat(params: dict, deadline: float = None) -> dict:
+    """Runs ask_qwen with `params` on a pooled page, after any earlier turns of the same chat."""
+    try:
+        await chat_turns.acquire(params["chat_id"], deadline)
+        try:
+            page = await browser_manager.get_page(params["chat_id"], deadline, params["model_name"])
+            try:
+                result = await tracer.run(page, "chat", ask_qwen(
+                    page, **params, capture_mode=browser_manager.capture_mode, page_state=browser_manager.page_state(page)))
+            finally:
+                browser_manager.release_page(page)
+        finally:
+            chat_turns.release(params["chat_id"])
+    finally:
+        release_uploads(params["files"])
+    note_new_chat(params["chat_id"], result)
+    return result
 
-    page = await browser_manager.get_page()
+async def run_image(prompt: str, deadline: float = None, timeouts: dict = None) -> dict:
+    """Runs generate_qwen_image on a pooled page."""
+    page = await browser_manager.get_page(deadline=deadline)
     try:
-        result = await ask_qwen(page, prompt, chat_id, use_web_search, file_paths, agent_name, model_name)
+        result = await tracer.run(page, "image", generate_qwen_image(
+            page, prompt, timeouts, page_state=browser_manager.page_state(page)))
     finally:
         browser_manager.release_page(page)
+    note_new_chat(None, result)
+    return result
 
-    return jsonify(result), 200 if result['status'] == 'success' else 500
+@app.route('/api/chat', methods=['POST'])
+async def chat_handler():
+    params, error = await parse_chat_request()
+    if error:
+        return error
+
+    deadline = request_deadline()
+    cache_key = await response_cache_key(params)
+    if cache_key is None:
+        result = await run_chat(params, deadline)
+        cache_status = "BYPASS" if RESPONSE_CACHE_ENABLED else None
+    else:
+        try:
+            result, cache_status = await response_cache.get_or_load(
+                cache_key, lambda: run_chat(params, deadline), cacheable=lambda result: result["status"] == "success"
+            )
+        finally:
+            # A cache hit or a shared load never ran this request's chat.
+            release_uploads(params["files"])
+        log.info(f"Response cache {cache_status} for key {cache_key[:12]}.")
+
+    response = jsonify(result)
+    response.status_code = 200 if result['status'] == 'success' else 500
+    if cache_status:
+        response.headers["X-Cache"] = cache_status
+    return response
+
+@app.route('/api/chat/stream', methods=['POST'])
+async def chat_stream_handler():
+    """
+    Same inputs as /api/chat, but answers with a text/event-stream:
+    `delta` events carry new response text as it appears, and a final `done`
+    event carries the same payload /api/chat would have returned.
+    """
+    params, error = await parse_chat_request()
+    if error:
+        return error
+
+    events = asyncio.Queue()
+    # Acquired before the stream starts, so an overloaded pool still gets a proper 503.
+    deadline = request_deadline()
+    try:
+        await chat_turns.acquire(params["chat_id"], deadline)
+        try:
+            page = await browser_manager.get_page(params["chat_id"], deadline, params["model_name"])
+        except BaseException:
+            chat_turns.release(params["chat_id"])
+            raise
+    except BaseException:
+        release_uploads(params["files"])
+        raise
+
+    async def run_streamed_chat():
+        try:
+            result = await tracer.run(page, "chat", ask_qwen(
+                page, **params, on_delta=events.put_nowait, capture_mode=browser_manager.capture_mode,
+                page_state=browser_manager.page_state(page)))
+        finally:
+            browser_manager.release_page(page)
+            chat_turns.release(params["chat_id"])
+            release_uploads(params["files"])
+        note_new_chat(params["chat_id"], result)
+        return result
+
+    # The chat runs as its own task so a disconnecting client doesn't abort a
+    # generation halfway and hand a half-finished page back to the pool.
+    chat_task = asyncio.ensure_future(run_streamed_chat())
+    chat_task.add_done_callback(lambda _: events.put_nowait(None))
+
+    async def event_stream():
+        while True:
+            try:
+                delta = await asyncio.wait_for(events.get(), timeout=15)
+            except asyncio.TimeoutError:
+                # SSE comment line keeps proxies from closing an idle connection.
+                yield ": keep-alive\n\n"
+                continue
+            if delta is None:
+                break
+            yield sse_event("delta", delta)
+        try:
+            result = chat_task.result()
+        except Exception as e:
+            result = {"status": "error", "message": str(e)}
+        yield sse_event("done", result)
+
+    response = Response(event_stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    # Generations routinely outlast Quart's default response timeout.
+    response.timeout = None
+    return response
+
+def batch_item_params(item) -> dict:
+    """Validates one entry of a /api/chat/batch request and returns its ask_qwen parameters."""
+    if not isinstance(item, dict) or not isinstance(item.get('prompt'), str) or not item['prompt']:
+        raise ValueError("Each item needs a non-empty 'prompt' string")
+    return {
+        "prompt": item['prompt'],
+        "chat_id": item.get('chat_id'),
+        "use_web_search": bool(item.get('use_web_search', False)),
+        "files": None,
+        "agent_name": item.get('agent_name'),
+        "model_name": item.get('model_name'),
+        "timeouts": parse_timeout_overrides(item.get('timeouts'), "completion"),
+    }
+
+@app.route('/api/chat/batch', methods=['POST'])
+async def chat_batch_handler():
+    """
+    Runs a list of chat requests concurrently across the page pool.
+
+    The body is {"prompts": [...]} (or just the list), where each item takes the same
+    fields as a JSON /api/chat body. Results are streamed back as NDJSON, one line per
+    item in the order they finish, each tagged with the item's `index`.
+    """
+    data = await request.get_json()
+    items = data.get('prompts') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({"status": "error", "message": "Request body must contain a non-empty 'prompts' list"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"status": "error", "message": f"A batch may contain at most {BATCH_MAX_ITEMS} prompts"}), 400
+    try:
+        batch = [batch_item_params(item) for item in items]
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    log.info(f"Received batch of {len(batch)} prompts.")
+    # Keeps the batch from flooding the pool's wait queue; the rest wait here instead.
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    started = set()
+
+    async def run_item(index: int, params: dict) -> dict:
+        async with slots:
+            started.add(index)
+            try:
+                result = await run_chat(params, time.monotonic() + DEFAULT_DEADLINE)
+            except PoolBusyError as e:
+                result = {"status": "error", "message": str(e)}
+            return {"index": index, **result}
+
+    tasks = {asyncio.ensure_future(run_item(i, params)): i for i, params in enumerate(batch)}
+
+    async def result_stream():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    result = await next_done
+                except Exception as e:
+                    result = {"status": "error", "message": str(e)}
+                yield json.dumps(result) + "\n"
+        finally:
+            # The client went away: drop the prompts that haven't reached a page yet.
+            for task, index in tasks.items():
+                if index not in started:
+                    task.cancel()
+
+    response = Response(result_stream(), mimetype="application/x-ndjson")
+    response.headers["X-Accel-Buffering"] = "no"
+    response.timeout = None
+    return response
 
 @app.route('/api/image', methods=['POST'])
 async def image_handler():
@@ -332,55 +1646,126 @@ async def image_handler():
         return jsonify({"status": "error", "message": "Missing 'prompt' in request body"}), 400
 
     prompt = data['prompt']
-    print(f"[*] Received request for /image: \"{prompt[:50]}...\"")
-
-    page = await browser_manager.get_page()
     try:
-        result = await generate_qwen_image(page, prompt)
-    finally:
-        browser_manager.release_page(page)
+        timeouts = parse_timeout_overrides(data.get('timeouts'), "image")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    log.info(f"Received request for /image: \"{prompt[:50]}...\"")
 
+    result = await run_image(prompt, request_deadline(), timeouts)
     return jsonify(result), 200 if result['status'] == 'success' else 500
 
-@app.route('/api/history', methods=['GET'])
-async def history_handler():
+async def send_stored_image(path: Path, etag: str):
+    """Serves a content-addressed file: its name never changes meaning, so it can be cached forever."""
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = await send_file(path, mimetype=mimetypes.guess_type(path.name)[0], add_etags=False)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+@app.route('/api/images/<image_id>', methods=['GET'])
+async def image_file_handler(image_id):
+    path = image_store.path(image_id)
+    if path is None:
+        return jsonify({"status": "error", "message": "Image not found"}), 404
+    return await send_stored_image(path, image_id)
+
+@app.route('/api/images/<image_id>/thumbnail', methods=['GET'])
+async def image_thumbnail_handler(image_id):
+    if not image_store.thumbnail_size:
+        return jsonify({"status": "error", "message": "Thumbnails are disabled"}), 404
+    path = await image_store.thumbnail(image_id)
+    if path is None:
+        return jsonify({"status": "error", "message": "Image not found"}), 404
+    return await send_stored_image(path, f"{image_id}-thumb")
+
+@app.route('/api/jobs/chat', methods=['POST'])
+async def chat_job_handler():
     """
-    Flask endpoint to fetch the user's chat history.
+    Queues a chat as a background job and answers at once with its id. Takes the
+    same body as /api/chat; poll GET /api/jobs/<job_id> for progress and the result.
     """
-    page = await browser_manager.get_page()
+    params, error = await parse_chat_request()
+    if error:
+        return error
     try:
-        print("[*] Fetching chat history...")
-        # Ensure we are on a page where the sidebar is visible by navigating to the base URL
-        if "/c/" not in page.url:
-            await page.goto(QWEN_URL, wait_until="networkidle")
+        job = job_manager.submit("chat", lambda: run_chat(params))
+    except JobQueueFullError as e:
+        release_uploads(params["files"])
+        raise PoolBusyError(str(e))
+    return job_accepted(job)
 
-        history_items_selector = 'div.session-list a.chat-item-drag-link'
-        history_items = page.locator(history_items_selector)
+@app.route('/api/jobs/image', methods=['POST'])
+async def image_job_handler():
+    """
+    Queues an image generation as a background job. Takes the same body as /api/image.
+    """
+    data = await request.get_json()
+    if not data or 'prompt' not in data:
+        return jsonify({"status": "error", "message": "Missing 'prompt' in request body"}), 400
+    prompt = data['prompt']
+    try:
+        timeouts = parse_timeout_overrides(data.get('timeouts'), "image")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    try:
+        job = job_manager.submit("image", lambda: run_image(prompt, timeouts=timeouts))
+    except JobQueueFullError as e:
+        raise PoolBusyError(str(e))
+    return job_accepted(job)
+
+def job_accepted(job: Job):
+    response = jsonify({"status": "success", "job": job_manager.describe(job)})
+    response.status_code = 202
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return response
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+async def job_status_handler(job_id: str):
+    """
+    Reports a job's status and queue position, and its result once it has finished.
+    Finished jobs are kept for JOB_RETENTION seconds.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"No job with id '{job_id}' (it may have expired)"}), 404
+    return jsonify({"status": "success", "job": job_manager.describe(job)}), 200
+
+async def run_metadata_query(name: str, query) -> dict:
+    """
+    Answers a read-only `query(page)` from the metadata cache. On a miss the query runs
+    on a pooled page, shared by all concurrent callers for the same `name`; stale
+    entries are refreshed in the background, but only when a page is idle.
+    """
+    async def load():
+        page = await browser_manager.get_page(deadline=deadline, prefer_fresh=False)
         try:
-            await history_items.first.wait_for(state="visible", timeout=15000)
-        except Exception as e:
-            print(f"[!] Error waiting for history items: {e}")
-            await save_error_state(page)
-
-        count = await history_items.count()
-        history = []
-        for i in range(count):
-            item = history_items.nth(i)
-            title_element = item.locator('.chat-item-drag-link-content-tip-text')
-            title = await title_element.inner_text()
-            href = await item.get_attribute('href')
-            chat_id = href.split('/c/')[-1]
-            history.append({"id": chat_id, "title": title.strip()})
-        
-        print(f"[+] Found {len(history)} chat sessions.")
-        result = {"status": "success", "history": history}
-    except Exception as e:
-        print(f"\n[!] An error occurred while fetching history: {e}")
-        await save_error_state(page)
-        result = {"status": "error", "message": str(e)}
-    finally:
-        browser_manager.release_page(page)
-    
+            return await query(page)
+        finally:
+            browser_manager.release_page(page)
+
+    async def refresh():
+        page = browser_manager.get_idle_page()
+        if page is None:
+            return None
+        try:
+            return await query(page)
+        finally:
+            browser_manager.release_page(page)
+
+    deadline = request_deadline()
+    # A partial result (e.g. a sidebar that hadn't loaded yet) is served but not kept.
+    return await metadata_cache.get(
+        name, load, refresh, cacheable=lambda result: result["status"] == "success" and not result.get("partial"))
+
+@app.route('/api/history', methods=['GET'])
+async def history_handler():
+    """
+    Flask endpoint to fetch the user's chat history.
+    """
+    result = await run_metadata_query("history", get_chat_history)
     return jsonify(result), 200 if result['status'] == 'success' else 500
 
 @app.route('/api/model', methods=['GET'])
@@ -388,19 +1773,7 @@ async def model_handler():
     """
     Flask endpoint to fetch the current model name.
     """
-    page = await browser_manager.get_page()
-    try:
-        print("[*] Fetching model information...")
-        model_selector_button = page.locator('div[class*="no-translate"] button')
-        await model_selector_button.wait_for(state="visible", timeout=15000)
-        model_name = await model_selector_button.inner_text()
-        result = {"status": "success", "model_name": model_name.strip()}
-    except Exception as e:
-        print(f"\n[!] An error occurred while fetching model info: {e}")
-        await save_error_state(page)
-        result = {"status": "error", "message": str(e)}
-    finally:
-        browser_manager.release_page(page)
+    result = await run_metadata_query("model", get_current_model)
     return jsonify(result), 200 if result['status'] == 'success' else 500
 
 @app.route('/api/models', methods=['GET'])
@@ -408,15 +1781,34 @@ async def models_handler():
     """
     Flask endpoint to fetch the list of available models.
     """
-    page = await browser_manager.get_page()
-    try:
-        result = await get_available_models(page)
-    except Exception as e:
-        result = {"status": "error", "message": str(e)}
-    finally:
-        browser_manager.release_page(page)
+    result = await run_metadata_query("models", get_available_models)
     return jsonify(result), 200 if result['status'] == 'success' else 500
 
+@app.route('/api/pool', methods=['GET'])
+async def pool_handler():
+    """
+    API endpoint to inspect the page pool: its current size and recent queue wait times.
+    """
+    metadata = {"hits": metadata_cache.hits, "misses": metadata_cache.misses}
+    return jsonify({
+        "status": "success",
+        "pool": browser_manager.stats(),
+        "metadata_cache": metadata,
+        "chats_with_queued_turns": chat_turns.queued_chats(),
+        "error_artifacts": error_artifacts.stats(),
+        "timeouts": stage_timeouts.stats(),
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_handler():
+    """
+    Prometheus scrape endpoint: pool wait and per-stage ask_qwen latency histograms,
+    pages in use versus idle, and request/error counters per endpoint.
+    """
+    update_pool_gauges(browser_manager.stats())
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
 # --- Frontend Serving ---
 @app.route('/')
 async def serve_index():
@@ -430,8 +1822,8 @@ async def serve_assets(filename):
 
 # Main entry point
 if __name__ == '__main__':
-    print("[*] Starting Qwen API server...")
-    print("[*] This server will launch a persistent browser in the background.")
-    print("[*] Listening on http://0.0.0.0:8010")
-    print("[*] Open http://127.0.0.1:8010 in your browser to use the web UI.")
+    log.info("Starting Qwen API server...")
+    log.info("This server will launch a persistent browser in the background.")
+    log.info("Listening on http://0.0.0.0:8010")
+    log.info("Open http://127.0.0.1:8010 in your browser to use the web UI.")
     app.run(host='0.0.0.0', port=8010)
\ No newline at end of file
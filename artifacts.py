@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from pathlib import Path
+
+from tracing import current_request_id
+
+log = logging.getLogger("qwen.artifacts")
+
+class ErrorArtifactStore:
+    """
+    Captures a screenshot and the HTML of a page that hit an error, and writes them
+    to disk in the background.
+
+    Only the capture itself happens on the request path, bounded by `capture_timeout`;
+    file writes are queued for a single writer task. Captures are rate limited with a
+    token bucket (`per_minute`, up to `burst` at once) so a storm of UI failures doesn't
+    keep every page busy taking screenshots. Files are named after the request id, and
+    the oldest are deleted once the directory holds more than `max_bytes`.
+    """
+    def __init__(self, directory: Path, max_bytes: int, per_minute: float, burst: int,
+                 capture_timeout: float, max_pending: int = 16):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.capture_timeout = capture_timeout
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.saved = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self._seq = 0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._writer: asyncio.Task = None
+        # (path, size) of the files written, oldest first; loaded from disk on first write.
+        self._files: deque = None
+        self._total_bytes = 0
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def capture(self, page, label: str):
+        """
+        Grabs the page's screenshot and HTML and queues them to be saved.
+        Never raises; errors while capturing are only logged.
+        """
+        if not self._take_token():
+            self.suppressed += 1
+            log.warning(f"Skipping error capture for '{label}', too many errors in a short time.")
+            return
+        try:
+            html, screenshot = await asyncio.wait_for(self._grab(page), self.capture_timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"Gave up capturing error state after {self.capture_timeout:g}s.")
+            return
+        except Exception as e:
+            log.warning(f"Could not capture error state: {e}")
+            return
+        self._seq += 1
+        stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{current_request_id.get() or 'untracked'}-{label}-{self._seq}"
+        try:
+            self._queue.put_nowait((stem, html, screenshot))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log.warning("Error artifact writer is behind, dropping this capture.")
+            return
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_loop())
+
+    async def _grab(self, page) -> tuple[str, bytes]:
+        html = await page.content()
+        # The visible viewport is enough to see what went wrong and is far cheaper
+        # than a full-page screenshot of a long conversation.
+        screenshot = await page.screenshot()
+        return html, screenshot
+
+    async def _write_loop(self):
+        while not self._queue.empty():
+            stem, html, screenshot = self._queue.get_nowait()
+            try:
+                paths = await asyncio.to_thread(self._write, stem, html, screenshot)
+                self.saved += 1
+                log.info(f"Saved error state to {', '.join(str(p) for p in paths)}")
+            except Exception as e:
+                log.warning(f"Could not save error state: {e}")
+
+    def _write(self, stem: str, html: str, screenshot: bytes) -> list[Path]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self._files is None:
+            existing = sorted((p for p in self.directory.iterdir() if p.is_file()), key=lambda p: p.stat().st_mtime)
+            self._files = deque((p, p.stat().st_size) for p in existing)
+            self._total_bytes = sum(size for _, size in self._files)
+        html_path = self.directory / f"{stem}.html"
+        html_path.write_text(html, encoding="utf-8")
+        png_path = self.directory / f"{stem}.png"
+        png_path.write_bytes(screenshot)
+        for path in (html_path, png_path):
+            size = path.stat().st_size
+            self._files.append((path, size))
+            self._total_bytes += size
+        while self._total_bytes > self.max_bytes and len(self._files) > 2:
+            old, size = self._files.popleft()
+            old.unlink(missing_ok=True)
+            self._total_bytes -= size
+        return [html_path, png_path]
+
+    def stats(self) -> dict:
+        return {
+            "saved": self.saved,
+            "suppressed": self.suppressed,
+            "dropped": self.dropped,
+            "disk_mb": round(self._total_bytes / (1024 * 1024), 1),
+        }
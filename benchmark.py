@@ -0,0 +1,93 @@
+"""
+End-to-end throughput benchmark for api_server.py.
+
+Sends chat requests at a fixed concurrency and reports latency percentiles and
+requests/second. Run it against a server backed by mock_qwen_server.py to measure
+pool and scheduling changes without touching chat.qwen.ai:
+
+    python mock_qwen_server.py --port 8020
+    QWEN_URL=http://127.0.0.1:8020/ python api_server.py
+    python benchmark.py --concurrency 4 --requests 40 --followup-ratio 0.5
+"""
+import argparse
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from utils import percentile
+
+def run_benchmark(server: str, concurrency: int, total: int, followup_ratio: float, timeout: float) -> dict:
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    # Each worker keeps its own conversation so follow-ups exercise chat affinity.
+    local = threading.local()
+
+    def one_request(i: int):
+        chat_id = getattr(local, "chat_id", None)
+        if chat_id is None or random.random() >= followup_ratio:
+            chat_id = None
+        payload = {"prompt": f"Benchmark request {i}: say something short.", "chat_id": chat_id}
+        started = time.perf_counter()
+        try:
+            response = requests.post(
+                f"{server}/api/chat", json=payload, timeout=timeout,
+                # Keep the response cache out of the measurements.
+                headers={"Cache-Control": "no-cache"},
+            )
+            status = response.status_code
+            if status == 200:
+                local.chat_id = response.json().get("chat_id")
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            statuses[status] += 1
+            if status == 200:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(total)))
+    duration = time.perf_counter() - started
+
+    return {
+        "requests": total,
+        "succeeded": len(latencies),
+        "statuses": dict(statuses),
+        "duration_s": duration,
+        "requests_per_s": len(latencies) / duration if duration else 0.0,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "max_s": max(latencies, default=0.0),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Qwen API server.")
+    parser.add_argument("--server", default="http://127.0.0.1:8010", help="Base URL of api_server.py.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once.")
+    parser.add_argument("--requests", type=int, default=40, help="Total number of requests.")
+    parser.add_argument("--followup-ratio", type=float, default=0.5,
+                        help="Share of requests that continue the worker's previous chat.")
+    parser.add_argument("--timeout", type=float, default=180, help="Per-request HTTP timeout in seconds.")
+    args = parser.parse_args()
+
+    print(f"[*] Sending {args.requests} requests to {args.server} at concurrency {args.concurrency}...")
+    result = run_benchmark(args.server, args.concurrency, args.requests, args.followup_ratio, args.timeout)
+
+    print(f"[+] {result['succeeded']}/{result['requests']} succeeded in {result['duration_s']:.1f}s")
+    print(f"    status codes: {result['statuses']}")
+    print(f"    throughput:   {result['requests_per_s']:.2f} requests/s")
+    print(f"    latency:      p50 {result['p50_s']:.2f}s  p95 {result['p95_s']:.2f}s  "
+          f"p99 {result['p99_s']:.2f}s  max {result['max_s']:.2f}s")
+    try:
+        pool = requests.get(f"{args.server}/api/pool", timeout=10).json().get("pool")
+        print(f"    pool:         {pool}")
+    except (requests.exceptions.RequestException, ValueError):
+        pass
+
+if __name__ == "__main__":
+    main()
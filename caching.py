@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+log = logging.getLogger("qwen.cache")
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into a single in-flight call.
+
+    The first caller for a key starts the work; everyone who asks for the same key
+    before it finishes waits for that result instead of starting their own.
+    """
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn):
+        """Returns the result of `await fn()`, shared with concurrent callers of `key`."""
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            log.info(f"Joining in-flight '{key}' request.")
+        # Shielded so one caller going away doesn't cancel the work for the others.
+        return await asyncio.shield(future)
+
+class _Entry:
+    def __init__(self, value):
+        self.value = value
+        self.stored_at = time.monotonic()
+
+class MetadataCache:
+    """
+    Keeps results of slow lookups for `ttl` seconds, with stale-while-revalidate.
+
+    After the TTL a cached value is still served for up to `max_stale` more seconds
+    while a background refresh runs; only older (or missing) entries make the
+    caller wait for a fresh load. Concurrent loads of one key are coalesced.
+    """
+    def __init__(self, ttl: float, max_stale: float):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entries: dict[str, _Entry] = {}
+        # key -> invalidation count, so a load started before invalidate() can't store its result.
+        self._generations: dict[str, int] = {}
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str, load, refresh=None, cacheable=lambda value: True):
+        """
+        Returns the cached value for `key`, calling `await load()` if there is none.
+
+        `refresh` is used for background revalidation and may return None to skip it
+        (e.g. when no idle page is free); it defaults to `load`. Only values for which
+        `cacheable(value)` is true are stored.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.stored_at
+            if age < self.ttl:
+                self.hits += 1
+                return entry.value
+            if age < self.ttl + self.max_stale:
+                self.hits += 1
+                asyncio.ensure_future(self._revalidate(key, refresh or load, cacheable))
+                return entry.value
+        self.misses += 1
+        return await self._load(key, load, cacheable)
+
+    async def _load(self, key: str, load, cacheable, flight_key: str = None):
+        async def load_and_store():
+            generation = self._generations.get(key, 0)
+            value = await load()
+            if (value is not None and self.ttl > 0 and cacheable(value)
+                    and self._generations.get(key, 0) == generation):
+                self._entries[key] = _Entry(value)
+            return value
+
+        return await self._flight.do(flight_key or key, load_and_store)
+
+    async def _revalidate(self, key: str, load, cacheable):
+        # In its own flight: a refresh may return None, which a caller's load must never get.
+        try:
+            await self._load(key, load, cacheable, flight_key=f"{key}:refresh")
+        except Exception as e:
+            log.warning(f"Background refresh of '{key}' failed: {e}")
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+        self._generations[key] = self._generations.get(key, 0) + 1
+
+class ResponseCache:
+    """
+    Two-level LRU cache for chat responses: an in-memory layer of `max_entries`
+    results in front of a directory of JSON files capped at `max_disk_bytes`.
+    Concurrent misses for one key wait for a single generation.
+
+    A reply was generated in the chat of the request that missed, so only that request
+    gets its `chat_id`; cached and shared copies carry `chat_id: null` instead of
+    sending unrelated clients into the same conversation.
+    """
+    def __init__(self, directory: Path, max_entries: int, max_disk_bytes: int):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: OrderedDict[str, dict] = OrderedDict()
+        # key -> file size, oldest first; loaded from the directory on first use.
+        self._disk_index: OrderedDict[str, int] = None
+        # Disk reads and writes run in worker threads; this keeps them from touching
+        # the index (and the same files) at the same time.
+        self._disk_lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def make_key(prompt: str, model_name: str, agent_name: str, file_hashes: list = None) -> str:
+        """
+        Builds the cache key for a new-chat request. The prompt's whitespace is normalized,
+        and attached files are identified by the SHA-256 of their contents, not their names.
+        """
+        material = json.dumps({
+            "prompt": " ".join((prompt or "").split()),
+            "model": model_name or "",
+            "agent": agent_name or "",
+            "files": sorted(file_hashes or []),
+        }, sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _load_disk_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        self._disk_index = OrderedDict((p.stem, p.stat().st_size) for p in files)
+
+    def _read_disk(self, key: str) -> dict:
+        with self._disk_lock:
+            return self._read_disk_locked(key)
+
+    def _read_disk_locked(self, key: str) -> dict:
+        if self._disk_index is None:
+            self._load_disk_index()
+        if key not in self._disk_index:
+            return None
+        path = self._path(key)
+        try:
+            value = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self._disk_index.pop(key, None)
+            return None
+        # Touch the file so the LRU order survives a restart.
+        os.utime(path)
+        self._disk_index.move_to_end(key)
+        return value
+
+    def _write_disk(self, key: str, value: dict):
+        with self._disk_lock:
+            self._write_disk_locked(key, value)
+
+    def _write_disk_locked(self, key: str, value: dict):
+        if self._disk_index is None:
+            self._load_disk_index()
+        data = json.dumps(value).encode("utf-8")
+        tmp_path = self._path(key).with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self._path(key))
+        self._disk_index[key] = len(data)
+        self._disk_index.move_to_end(key)
+        while sum(self._disk_index.values()) > self.max_disk_bytes and len(self._disk_index) > 1:
+            old_key, _ = self._disk_index.popitem(last=False)
+            try:
+                self._path(old_key).unlink()
+            except OSError:
+                pass
+
+    def _remember(self, key: str, value: dict):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str) -> dict:
+        value = self._memory.get(key)
+        if value is not None:
+            self._memory.move_to_end(key)
+            return value
+        value = await asyncio.to_thread(self._read_disk, key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    async def put(self, key: str, value: dict):
+        self._remember(key, value)
+        await asyncio.to_thread(self._write_disk, key, value)
+
+    async def get_or_load(self, key: str, load, cacheable=lambda value: True) -> tuple[dict, str]:
+        """
+        Returns (value, outcome), where outcome is "HIT" for a cached value, "MISS" if
+        this call ran `load`, or "SHARED" if it waited for a concurrent call's load.
+        """
+        value = await self.get(key)
+        if value is not None:
+            return self._shared_copy(value), "HIT"
+
+        loaded_here = False
+
+        async def load_and_store():
+            nonlocal loaded_here
+            loaded_here = True
+            value = await load()
+            if cacheable(value):
+                try:
+                    await self.put(key, self._shared_copy(value))
+                except OSError as e:
+                    log.warning(f"Could not write response cache entry: {e}")
+            return value
+
+        value = await self._flight.do(key, load_and_store)
+        if loaded_here:
+            return value, "MISS"
+        return self._shared_copy(value), "SHARED"
+
+    @staticmethod
+    def _shared_copy(value: dict) -> dict:
+        """The value as given to requests other than the one that generated it."""
+        if value.get("chat_id") is None:
+            return value
+        return {**value, "chat_id": None}
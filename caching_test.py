@@ -0,0 +1,110 @@
+# Run with: python -m pytest caching_test.py
+import asyncio
+
+from caching import MetadataCache
+
+HISTORY = {"status": "success", "history": [{"id": "1", "title": "old"}]}
+NEW_HISTORY = {"status": "success", "history": [{"id": "2", "title": "new"}]}
+
+def loader(value, delay: float = 0):
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return value
+
+    load.calls = calls
+    return load
+
+def test_fresh_entry_is_served_from_cache():
+    async def main():
+        cache = MetadataCache(ttl=60, max_stale=60)
+        load = loader(HISTORY)
+        assert await cache.get("history", load) == HISTORY
+        assert await cache.get("history", load) == HISTORY
+        assert len(load.calls) == 1 and cache.hits == 1 and cache.misses == 1
+
+    asyncio.run(main())
+
+def test_miss_does_not_join_a_refresh_that_finds_no_page():
+    async def main():
+        cache = MetadataCache(ttl=0.01, max_stale=60)
+        await cache.get("history", loader(HISTORY))
+        await asyncio.sleep(0.02)
+        no_idle_page = loader(None, delay=0.05)
+        # Stale hit: starts a background refresh, which will come back with None.
+        assert await cache.get("history", loader(NEW_HISTORY), no_idle_page) == HISTORY
+        await asyncio.sleep(0)
+        cache.invalidate("history")
+        assert await cache.get("history", loader(NEW_HISTORY, delay=0.01), no_idle_page) == NEW_HISTORY
+
+    asyncio.run(main())
+
+def test_load_started_before_invalidate_is_not_stored():
+    async def main():
+        cache = MetadataCache(ttl=60, max_stale=60)
+        started = asyncio.ensure_future(cache.get("history", loader(HISTORY, delay=0.02)))
+        await asyncio.sleep(0.01)
+        cache.invalidate("history")
+        # The caller still gets its result...
+        assert await started == HISTORY
+        # ...but the next one loads again instead of being served the pre-invalidation list.
+        assert await cache.get("history", loader(NEW_HISTORY)) == NEW_HISTORY
+
+    asyncio.run(main())
+
+def test_concurrent_misses_share_one_load():
+    async def main():
+        cache = MetadataCache(ttl=60, max_stale=60)
+        load = loader(HISTORY, delay=0.01)
+        results = await asyncio.gather(*(cache.get("history", load) for _ in range(5)))
+        assert results == [HISTORY] * 5 and len(load.calls) == 1
+
+    asyncio.run(main())
+
+def test_uncacheable_result_is_returned_but_not_kept():
+    async def main():
+        cache = MetadataCache(ttl=60, max_stale=60)
+        partial = {"status": "success", "history": [], "partial": True}
+        cacheable = lambda result: result["status"] == "success" and not result.get("partial")
+        assert await cache.get("history", loader(partial), cacheable=cacheable) == partial
+        assert await cache.get("history", loader(HISTORY), cacheable=cacheable) == HISTORY
+
+    asyncio.run(main())
+
+def make_response_cache(tmp_path, max_entries: int = 10, max_disk_bytes: int = 1 << 20):
+    from caching import ResponseCache
+    return ResponseCache(tmp_path, max_entries=max_entries, max_disk_bytes=max_disk_bytes)
+
+REPLY = {"status": "success", "response": "Hi", "code_blocks": [], "chat_id": "chat-1"}
+
+def test_only_the_generating_request_gets_the_chat_id(tmp_path):
+    async def main():
+        cache = make_response_cache(tmp_path)
+        results = await asyncio.gather(*(cache.get_or_load("key", loader(REPLY, delay=0.01)) for _ in range(3)))
+        assert sorted((outcome, value["chat_id"]) for value, outcome in results) == [
+            ("MISS", "chat-1"), ("SHARED", None), ("SHARED", None)]
+        value, outcome = await cache.get_or_load("key", loader(REPLY))
+        assert outcome == "HIT" and value["chat_id"] is None and value["response"] == "Hi"
+        # Nor is it kept on disk for later processes.
+        cache._memory.clear()
+        value, outcome = await cache.get_or_load("key", loader(REPLY))
+        assert outcome == "HIT" and value["chat_id"] is None
+
+    asyncio.run(main())
+
+def test_disk_reads_and_writes_from_many_threads_keep_the_index_consistent(tmp_path):
+    async def main():
+        cache = make_response_cache(tmp_path, max_entries=1, max_disk_bytes=2000)
+
+        async def use(i):
+            await cache.put(f"k{i % 30}", {"status": "success", "response": "x" * 50})
+            await cache.get(f"k{(i * 7) % 30}")
+
+        await asyncio.gather(*(use(i) for i in range(300)))
+        on_disk = {p.stem: p.stat().st_size for p in tmp_path.glob("*.json")}
+        assert on_disk == dict(cache._disk_index)
+        assert sum(on_disk.values()) <= 2000
+
+    asyncio.run(main())
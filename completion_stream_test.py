@@ -0,0 +1,113 @@
+# Run with: python -m pytest completion_stream_test.py
+import asyncio
+import json
+
+import pytest
+
+from api_server import (
+    IncompleteCompletionError, ResponseStalledError, _ProgressWatch, read_completion_response, wait_unless_stalled,
+)
+from timeouts import StageTimeouts, timeout_key
+from utils import parse_completion_stream
+
+def sse(*events) -> str:
+    return "".join(f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n" for event in events)
+
+def delta(content: str = "", phase: str = "answer", **extra) -> dict:
+    return {"choices": [{"delta": {"content": content, "phase": phase, **extra}}]}
+
+class FakeResponse:
+    def __init__(self, body: str, status: int = 200, url: str = "https://chat.qwen.ai/api/chat/completions?chat_id=abc",
+                 delay: float = 0):
+        self.body = body
+        self.status = status
+        self.ok = status < 400
+        self.url = url
+        self.delay = delay
+
+    async def text(self) -> str:
+        await asyncio.sleep(self.delay)
+        return self.body
+
+FINISHED = sse(
+    {"response.created": {"chat_id": "chat-1"}},
+    delta("Let me think", phase="think"),
+    delta("Hel"),
+    delta("lo"),
+    delta(status="finished"),
+)
+
+def test_parse_collects_answer_phase_only():
+    captured = parse_completion_stream(FINISHED)
+    assert captured == {"text": "Hello", "chat_id": "chat-1", "finished": True}
+
+def test_parse_done_marker_and_finish_reason_count_as_finished():
+    assert parse_completion_stream(sse(delta("a"), "[DONE]"))["finished"]
+    assert parse_completion_stream(sse({"choices": [{"delta": {"content": "a"}, "finish_reason": "stop"}]}))["finished"]
+
+def test_parse_skips_malformed_lines():
+    body = "event: ping\n\ndata: {not json\n\ndata: [1, 2]\n\n" + sse(delta("ok"), "[DONE]")
+    assert parse_completion_stream(body) == {"text": "ok", "chat_id": None, "finished": True}
+
+def test_parse_cut_off_stream_is_not_finished():
+    assert parse_completion_stream(sse(delta("Hel"))) == {"text": "Hel", "chat_id": None, "finished": False}
+
+def test_read_returns_finished_reply():
+    captured = asyncio.run(read_completion_response(FakeResponse(FINISHED), timeout=1))
+    assert captured["text"] == "Hello" and captured["chat_id"] == "chat-1"
+
+def test_read_takes_chat_id_from_url_when_stream_has_none():
+    captured = asyncio.run(read_completion_response(FakeResponse(sse(delta("Hi"), "[DONE]")), timeout=1))
+    assert captured["chat_id"] == "abc"
+
+def test_read_rejects_unfinished_stream():
+    with pytest.raises(IncompleteCompletionError):
+        asyncio.run(read_completion_response(FakeResponse(sse(delta("Hel"))), timeout=1))
+
+def test_read_times_out():
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(read_completion_response(FakeResponse(FINISHED, delay=1), timeout=0.01))
+
+def test_read_returns_none_for_unusable_payload():
+    assert asyncio.run(read_completion_response(FakeResponse(FINISHED, status=500), timeout=1)) is None
+    assert asyncio.run(read_completion_response(FakeResponse(sse(delta(status="finished"))), timeout=1)) is None
+
+def stall_budget(stall_seconds: float):
+    return StageTimeouts(quantile=99, margin=2, min_samples=20, window=200).budget(timeout_key(), {"stall": stall_seconds})
+
+def test_wait_gives_up_on_a_page_that_stops_producing_output():
+    async def main():
+        watch = _ProgressWatch()
+        with pytest.raises(ResponseStalledError):
+            await wait_unless_stalled(asyncio.sleep(10), watch, stall_budget(0.05))
+
+    asyncio.run(main())
+
+def test_wait_keeps_going_while_output_arrives():
+    async def main():
+        snapshots = []
+        watch = _ProgressWatch(snapshots.append)
+
+        async def slow_reply():
+            for i in range(5):
+                await asyncio.sleep(0.03)
+                watch(f"part {i}")
+            return "done"
+
+        # The reply takes three times the stall timeout, but never goes quiet for that long.
+        assert await wait_unless_stalled(slow_reply(), watch, stall_budget(0.05)) == "done"
+        assert snapshots[-1] == "part 4"
+        assert 0.03 <= watch.longest_silence < 0.05
+
+    asyncio.run(main())
+
+def test_stall_timeout_is_learned_from_the_longest_silences():
+    async def main():
+        timeouts = StageTimeouts(quantile=99, margin=2, min_samples=3, window=200, limits={"stall": (1, 10000)})
+        for _ in range(3):
+            watch = _ProgressWatch()
+            await wait_unless_stalled(asyncio.sleep(0.02), watch, timeouts.budget(timeout_key()))
+        # About twice the 20 ms silences instead of the 60 s default.
+        assert 40 <= timeouts.timeout_ms("stall", timeout_key()) < 1000
+
+    asyncio.run(main())
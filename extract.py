@@ -0,0 +1,52 @@
+import re
+
+from playwright.async_api import Locator, Page
+
+# Each structure is read out of the page with a single evaluate call returning JSON,
+# instead of one Playwright round trip per item and attribute.
+
+_HISTORY_JS = """
+(selector) => Array.from(document.querySelectorAll(selector), (item) => ({
+    href: item.getAttribute('href') || '',
+    title: (item.querySelector('.chat-item-drag-link-content-tip-text')?.innerText || '').trim(),
+}))
+"""
+
+_TEXTS_JS = "(elements) => elements.map((element) => element.innerText)"
+
+# Takes the .markdown-content-container of a response bubble.
+_RESPONSE_JS = """
+(body) => ({
+    text: body.innerText,
+    code_blocks: Array.from(body.querySelectorAll('pre'), (pre) => {
+        const code = pre.querySelector('code') || pre;
+        const languageClass = [...code.classList, ...pre.classList].find((c) => c.startsWith('language-'));
+        return {
+            language: languageClass ? languageClass.slice('language-'.length) : (pre.dataset.language || ''),
+            code: code.innerText,
+        };
+    }),
+})
+"""
+
+_FENCE_RE = re.compile(r"^(`{3,}|~{3,})[ \t]*([^\n`]*)\n(.*?)^\1[ \t]*$", re.MULTILINE | re.DOTALL)
+
+async def extract_history(page: Page, selector: str) -> list[dict]:
+    """Returns {"id", "title"} for every sidebar chat link matching `selector`."""
+    items = await page.evaluate(_HISTORY_JS, selector)
+    return [{"id": item["href"].split('/c/')[-1], "title": item["title"]} for item in items]
+
+async def extract_texts(locator: Locator) -> list[str]:
+    """Returns the inner text of every element `locator` matches."""
+    return await locator.evaluate_all(_TEXTS_JS)
+
+async def extract_response(markdown_container: Locator) -> dict:
+    """Returns the rendered text of a response and its code blocks ({"language", "code"})."""
+    return await markdown_container.evaluate(_RESPONSE_JS)
+
+def code_blocks_from_markdown(text: str) -> list[dict]:
+    """Finds the fenced code blocks in raw markdown, as extract_response does for rendered replies."""
+    return [
+        {"language": info.split()[0] if info.strip() else "", "code": code.rstrip("\n")}
+        for _, info, code in _FENCE_RE.findall(text or "")
+    ]
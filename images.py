@@ -0,0 +1,124 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:  # Thumbnails are optional.
+    Image = None
+
+log = logging.getLogger("qwen.images")
+
+IMAGE_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# Reads an <img>'s bytes from inside the page, which is the only place a blob: URL resolves.
+READ_IMAGE_JS = """
+async (img) => {
+    const response = await fetch(img.src);
+    const blob = await response.blob();
+    const dataUrl = await new Promise((resolve, reject) => {
+        const reader = new FileReader();
+        reader.onload = () => resolve(reader.result);
+        reader.onerror = () => reject(reader.error);
+        reader.readAsDataURL(blob);
+    });
+    return {type: blob.type, data: dataUrl.slice(dataUrl.indexOf(',') + 1)};
+}
+"""
+
+def _make_thumbnail(source: str, target: str, size: int):
+    """Runs in a worker process."""
+    with Image.open(source) as image:
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        # Written aside and renamed, so a half-written thumbnail is never served.
+        image.save(target + ".part", "JPEG", quality=85)
+    os.replace(target + ".part", target)
+
+class ImageStore:
+    """
+    Keeps generated images on disk named by the SHA-256 of their bytes, so each one
+    gets a stable URL that can be cached forever. With Pillow installed and
+    `thumbnail_size` set, JPEG thumbnails are made in a pool of worker processes.
+    """
+    def __init__(self, directory: Path, thumbnail_size: int = 0, workers: int = 2):
+        self.directory = Path(directory)
+        self.thumbnail_size = thumbnail_size if Image is not None else 0
+        self.workers = workers
+        self._executor: ProcessPoolExecutor = None
+        # image id -> running thumbnail job, so concurrent requests share it.
+        self._thumbnail_jobs: dict[str, asyncio.Future] = {}
+        if thumbnail_size and Image is None:
+            log.warning("Pillow is not installed, image thumbnails are disabled.")
+
+    async def read_from_page(self, page, image_locator) -> tuple[bytes, str]:
+        """Returns the bytes and content type of the image shown by `image_locator`."""
+        src = await image_locator.get_attribute("src")
+        if src.startswith("http"):
+            # Fetched with the browser context's cookies, outside the page's CORS rules.
+            response = await page.request.get(src)
+            if not response.ok:
+                raise RuntimeError(f"Image download failed with HTTP {response.status}")
+            return await response.body(), response.headers.get("content-type", "")
+        result = await image_locator.evaluate(READ_IMAGE_JS)
+        return base64.b64decode(result["data"]), result["type"]
+
+    def _write(self, data: bytes, content_type: str) -> str:
+        image_id = hashlib.sha256(data).hexdigest()
+        extension = mimetypes.guess_extension((content_type or "").split(";")[0].strip()) or ".bin"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.path(image_id) is None:
+            temp = self.directory / f"{image_id}.part"
+            temp.write_bytes(data)
+            temp.replace(self.directory / f"{image_id}{extension}")
+        return image_id
+
+    async def put(self, data: bytes, content_type: str) -> str:
+        """Stores the image and returns its id (the hash of its bytes)."""
+        image_id = await asyncio.to_thread(self._write, data, content_type)
+        if self.thumbnail_size:
+            # Started now so it is usually ready before anyone asks for it.
+            asyncio.ensure_future(self.thumbnail(image_id))
+        return image_id
+
+    def path(self, image_id: str) -> Path:
+        """Returns the stored file for `image_id`, or None."""
+        if not IMAGE_ID_RE.match(image_id):
+            return None
+        return next((p for p in self.directory.glob(f"{image_id}.*")
+                     if p.suffix != ".part" and not p.name.endswith(".thumb.jpg")), None)
+
+    async def thumbnail(self, image_id: str) -> Path:
+        """Returns the image's thumbnail, making it first if needed. None if thumbnails are off."""
+        source = self.path(image_id)
+        if not self.thumbnail_size or source is None:
+            return None
+        target = self.directory / f"{image_id}.thumb.jpg"
+        if target.exists():
+            return target
+        job = self._thumbnail_jobs.get(image_id)
+        if job is None:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            job = asyncio.get_running_loop().run_in_executor(
+                self._executor, _make_thumbnail, str(source), str(target), self.thumbnail_size
+            )
+            self._thumbnail_jobs[image_id] = job
+            job.add_done_callback(lambda _: self._thumbnail_jobs.pop(image_id, None))
+        try:
+            await asyncio.shield(job)
+        except Exception as e:
+            log.warning(f"Could not make a thumbnail for image {image_id[:12]}: {e}")
+            return None
+        return target
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
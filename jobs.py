@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+log = logging.getLogger("qwen.jobs")
+
+class JobQueueFullError(Exception):
+    """Raised when too many jobs are already waiting to run."""
+
+class Job:
+    """A unit of background work and, once it has finished, its result."""
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        # queued -> running -> succeeded | failed
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: float = None
+        self.finished_at: float = None
+        self.result: dict = None
+        self.task: asyncio.Task = None
+
+class JobManager:
+    """
+    Runs submitted jobs in the background, at most `concurrency` at a time in
+    submission order, and keeps finished jobs around for `retention` seconds so
+    clients can collect their results.
+    """
+    def __init__(self, concurrency: int, retention: float, max_pending: int):
+        self.retention = retention
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(concurrency)
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        # Jobs that haven't started, oldest first, for queue positions.
+        self._queued: OrderedDict[str, Job] = OrderedDict()
+
+    def submit(self, kind: str, run) -> Job:
+        """Queues `await run()`, which must return a result dict, and returns the new job."""
+        self._expire()
+        if len(self._queued) >= self.max_pending:
+            raise JobQueueFullError(f"Too many queued jobs ({len(self._queued)}).")
+        job = Job(kind)
+        self._jobs[job.id] = job
+        self._queued[job.id] = job
+        job.task = asyncio.ensure_future(self._run(job, run))
+        log.info(f"Queued {kind} job {job.id}.")
+        return job
+
+    async def _run(self, job: Job, run):
+        async with self._slots:
+            self._queued.pop(job.id, None)
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                job.result = await run()
+            except Exception as e:
+                job.result = {"status": "error", "message": str(e)}
+            job.status = "succeeded" if job.result.get("status") == "success" else "failed"
+            job.finished_at = time.time()
+            log.info(f"{job.kind.capitalize()} job {job.id} {job.status}.")
+
+    def get(self, job_id: str) -> Job:
+        self._expire()
+        return self._jobs.get(job_id)
+
+    def queue_position(self, job: Job) -> int:
+        """1-based position among jobs waiting to start, or 0 once it has started."""
+        if job.id not in self._queued:
+            return 0
+        return list(self._queued).index(job.id) + 1
+
+    def describe(self, job: Job) -> dict:
+        info = {
+            "id": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "queue_position": self.queue_position(job),
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+        }
+        if job.result is not None:
+            info["result"] = job.result
+        return info
+
+    def _expire(self):
+        """Forgets finished jobs older than the retention window."""
+        cutoff = time.time() - self.retention
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
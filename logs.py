@@ -0,0 +1,111 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from contextvars import ContextVar
+
+from tracing import current_request_id
+
+# Structured fields shown on every record that carries them.
+FIELDS = ("request_id", "page_id", "chat_id", "stage", "duration_ms")
+
+# Fields bound to the current task (and the tasks it starts) with bind().
+_bound_fields: ContextVar[dict] = ContextVar("log_fields", default={})
+
+def bind(**fields):
+    """Attaches `fields` (e.g. page_id, chat_id) to every later log record from this task."""
+    _bound_fields.set({**_bound_fields.get(), **fields})
+
+class _ContextFilter(logging.Filter):
+    """
+    Fills in the request id and bound fields, and samples records below WARNING from
+    loggers given a sample rate, so high-volume messages can be thinned out.
+    Runs in the caller before the record is queued, while the contextvars still hold
+    the request's values.
+    """
+    def __init__(self, sample_rates: dict):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def _sample_rate(self, name: str) -> float:
+        while name:
+            if name in self.sample_rates:
+                return self.sample_rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            rate = self._sample_rate(record.name)
+            if rate < 1 and random.random() >= rate:
+                return False
+        for key, value in _bound_fields.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        if not hasattr(record, "request_id"):
+            record.request_id = current_request_id.get()
+        return True
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, dropping them instead of blocking when it falls behind."""
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = " ".join(f"{key}={getattr(record, key)}" for key in FIELDS if getattr(record, key, None) is not None)
+        return f"{line} [{fields}]" if fields else line
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+def parse_sample_rates(items: list[str]) -> dict:
+    """Parses "logger=rate" entries, e.g. ["qwen.pool=0.1"]."""
+    rates = {}
+    for item in items:
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+def setup_logging(level: str, fmt: str, sample_rates: dict, max_queue: int) -> logging.handlers.QueueListener:
+    """
+    Routes the "qwen" loggers through a bounded queue to a writer thread, so a slow
+    stdout (a full pipe, a redirected log file) never stalls the event loop.
+    Returns the started listener; stop it on shutdown to flush the queue.
+    """
+    log_queue = queue.Queue(max_queue)
+    handler = _DroppingQueueHandler(log_queue)
+    handler.addFilter(_ContextFilter(sample_rates))
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    logger = logging.getLogger("qwen")
+    logger.setLevel(level.upper())
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    return listener
@@ -0,0 +1,105 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+from tracing import record_stage
+
+log = logging.getLogger("qwen.browser")
+
+# A private registry so only the server's own metrics are exported, not the
+# default process/platform collectors.
+REGISTRY = CollectorRegistry()
+
+# Browser steps range from a few milliseconds (a cached toggle) to minutes (a long reply).
+_STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180, 300, 600, 900)
+
+POOL_WAIT_SECONDS = Histogram(
+    "qwen_pool_wait_seconds",
+    "Time requests spent waiting for a page from the pool.",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    registry=REGISTRY,
+)
+ASK_STAGE_SECONDS = Histogram(
+    "qwen_ask_stage_seconds",
+    "Time spent in each stage of ask_qwen and generate_qwen_image.",
+    ["stage"],
+    buckets=_STAGE_BUCKETS,
+    registry=REGISTRY,
+)
+ASK_STAGE_FAILURES = Counter(
+    "qwen_ask_stage_failures_total",
+    "ask_qwen and generate_qwen_image stages that raised an exception.",
+    ["stage"],
+    registry=REGISTRY,
+)
+UI_TOGGLES = Counter(
+    "qwen_ui_toggles_total",
+    "Model and web search settings requested, by whether the page had to be changed or was already set.",
+    ["control", "outcome"],
+    registry=REGISTRY,
+)
+POOL_PAGES = Gauge(
+    "qwen_pool_pages",
+    "Pages in the pool by state.",
+    ["state"],
+    registry=REGISTRY,
+)
+POOL_QUEUED = Gauge(
+    "qwen_pool_queued_requests",
+    "Requests waiting for a page.",
+    registry=REGISTRY,
+)
+REQUEST_SECONDS = Histogram(
+    "qwen_http_request_seconds",
+    "Time to produce a response, per endpoint. Streaming endpoints stop the clock once the stream starts.",
+    ["endpoint", "method"],
+    buckets=_STAGE_BUCKETS,
+    registry=REGISTRY,
+)
+REQUEST_ERRORS = Counter(
+    "qwen_http_request_errors_total",
+    "Responses with a 4xx or 5xx status, per endpoint.",
+    ["endpoint", "method", "status"],
+    registry=REGISTRY,
+)
+
+@contextmanager
+def stage_timer(stage: str, budget=None):
+    """
+    Times the enclosed block as one `ask_qwen` stage, counting it as failed if it raises,
+    and adds it to the current request trace (if one is being recorded) and the debug log.
+    With a TimeoutBudget, the duration also feeds the stage's learned timeout.
+    """
+    started = time.perf_counter()
+    failed = False
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        failed = True
+        error = e
+        ASK_STAGE_FAILURES.labels(stage).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        ASK_STAGE_SECONDS.labels(stage).observe(elapsed)
+        if budget is not None:
+            budget.record(stage, elapsed, error)
+        record_stage(stage, elapsed, failed)
+        log.debug(f"Stage {'failed' if failed else 'finished'}.", extra={"stage": stage, "duration_ms": round(elapsed * 1000)})
+
+def observe_request(endpoint: str, method: str, status: int, seconds: float):
+    REQUEST_SECONDS.labels(endpoint, method).observe(seconds)
+    if status >= 400:
+        REQUEST_ERRORS.labels(endpoint, method, str(status)).inc()
+
+def update_pool_gauges(stats: dict):
+    """Copies the page counts from `BrowserManager.stats()` into the gauges."""
+    POOL_PAGES.labels("busy").set(stats["busy"])
+    POOL_PAGES.labels("idle").set(stats["idle"])
+    POOL_QUEUED.set(stats["queued"])
+
+def render_metrics() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
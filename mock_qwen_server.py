@@ -0,0 +1,145 @@
+"""
+Offline stand-in for chat.qwen.ai, for benchmarking api_server.py without the real site.
+
+It serves a page with the same DOM contract the server automates (chat input, response
+bubbles, regenerate button, model selector, session list, web search toggle, action
+buttons, file input) and streams replies over a /api/v2/chat/completions SSE endpoint
+in Qwen's event format, so both the DOM and network capture modes work against it.
+
+Usage:
+    python mock_qwen_server.py --port 8020 --first-token-delay 1.0 --tokens-per-second 40
+    QWEN_URL=http://127.0.0.1:8020/ python api_server.py
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from pathlib import Path
+from quart import Quart, Response, request, jsonify, send_from_directory
+
+MOCK_ROOT = Path(__file__).resolve().parent / "mock_qwen"
+# A 1x1 transparent PNG, served as every "generated" image.
+PLACEHOLDER_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+FILLER_WORDS = "the quick brown fox jumps over a lazy dog while the pool keeps every tab busy".split()
+
+app = Quart(__name__)
+app.config.update(
+    FIRST_TOKEN_DELAY=1.0,
+    TOKENS_PER_SECOND=40.0,
+    RESPONSE_TOKENS=120,
+    IMAGE_DELAY=3.0,
+    JITTER=0.2,
+)
+
+# chat_id -> {"id", "title", "updated_at", "messages": [{"role", "content", "image_url"?}]}
+chats = {}
+
+def jittered(seconds: float) -> float:
+    """Varies a delay by up to +/- JITTER so runs don't move in lockstep."""
+    jitter = app.config["JITTER"]
+    return max(0.0, seconds * random.uniform(1 - jitter, 1 + jitter))
+
+def mock_reply(prompt: str) -> list[str]:
+    """Builds the tokens of a reply: an echo of the prompt, padded with filler words."""
+    tokens = f"Mock reply to: {prompt.strip()[:200]}.".split()
+    while len(tokens) < app.config["RESPONSE_TOKENS"]:
+        tokens.append(FILLER_WORDS[len(tokens) % len(FILLER_WORDS)])
+    return [token + " " for token in tokens]
+
+@app.route('/')
+@app.route('/c/<chat_id>')
+async def serve_index(chat_id=None):
+    return await send_from_directory(MOCK_ROOT, 'index.html')
+
+@app.route('/api/v2/chats', methods=['GET'])
+async def list_chats():
+    ordered = sorted(chats.values(), key=lambda c: c["updated_at"], reverse=True)
+    return jsonify([{"id": c["id"], "title": c["title"]} for c in ordered])
+
+@app.route('/api/v2/chats/new', methods=['POST'])
+async def new_chat():
+    data = await request.get_json()
+    chat_id = str(uuid.uuid4())
+    chats[chat_id] = {"id": chat_id, "title": data.get("title") or "New Chat", "updated_at": time.time(), "messages": []}
+    return jsonify({"id": chat_id})
+
+@app.route('/api/v2/chats/<chat_id>', methods=['GET'])
+async def get_chat(chat_id):
+    chat = chats.get(chat_id)
+    if chat is None:
+        return jsonify({"id": chat_id, "title": "", "messages": []}), 404
+    return jsonify(chat)
+
+@app.route('/api/v2/chat/completions', methods=['POST'])
+async def completions():
+    chat_id = request.args.get("chat_id")
+    data = await request.get_json()
+    prompt = data.get("prompt", "")
+    chat = chats.setdefault(chat_id, {"id": chat_id, "title": prompt[:40], "updated_at": time.time(), "messages": []})
+    chat["messages"].append({"role": "user", "content": prompt})
+
+    async def stream():
+        created = {"response.created": {"chat_id": chat_id, "response_id": str(uuid.uuid4())}}
+        yield f"data: {json.dumps(created)}\n\n"
+        await asyncio.sleep(jittered(app.config["FIRST_TOKEN_DELAY"]))
+        text = []
+        for token in mock_reply(prompt):
+            text.append(token)
+            event = {"choices": [{"delta": {"role": "assistant", "content": token, "phase": "answer", "status": "typing"}}]}
+            yield f"data: {json.dumps(event)}\n\n"
+            await asyncio.sleep(1 / app.config["TOKENS_PER_SECOND"])
+        done = {"choices": [{"delta": {"role": "assistant", "content": "", "phase": "answer", "status": "finished"}}]}
+        yield f"data: {json.dumps(done)}\n\n"
+        chat["messages"].append({"role": "assistant", "content": "".join(text)})
+        chat["updated_at"] = time.time()
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.timeout = None
+    return response
+
+@app.route('/api/v2/images', methods=['POST'])
+async def generate_image():
+    chat_id = request.args.get("chat_id")
+    data = await request.get_json()
+    prompt = data.get("prompt", "")
+    await asyncio.sleep(jittered(app.config["IMAGE_DELAY"]))
+    image_url = f"/api/v2/images/{uuid.uuid4().hex}.png"
+    chat = chats.setdefault(chat_id, {"id": chat_id, "title": prompt[:40], "updated_at": time.time(), "messages": []})
+    chat["messages"].append({"role": "user", "content": prompt})
+    chat["messages"].append({"role": "assistant", "content": "", "image_url": image_url})
+    chat["updated_at"] = time.time()
+    return jsonify({"url": image_url})
+
+@app.route('/api/v2/images/<name>', methods=['GET'])
+async def serve_image(name):
+    return Response(PLACEHOLDER_PNG, mimetype="image/png")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stand-in for chat.qwen.ai.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8020)
+    parser.add_argument("--first-token-delay", type=float, default=1.0, help="Seconds before the first token of a reply.")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="Streaming speed of replies.")
+    parser.add_argument("--response-tokens", type=int, default=120, help="Length of each reply in tokens.")
+    parser.add_argument("--image-delay", type=float, default=3.0, help="Seconds to 'generate' an image.")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Relative random variation of the delays.")
+    args = parser.parse_args()
+
+    app.config.update(
+        FIRST_TOKEN_DELAY=args.first_token_delay,
+        TOKENS_PER_SECOND=args.tokens_per_second,
+        RESPONSE_TOKENS=args.response_tokens,
+        IMAGE_DELAY=args.image_delay,
+        JITTER=args.jitter,
+    )
+    print(f"[*] Mock Qwen listening on http://{args.host}:{args.port}/")
+    print(f"[*] Point the API server at it with QWEN_URL=http://{args.host}:{args.port}/")
+    app.run(host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# Run with: python -m pytest pool_test.py
+import asyncio
+import time
+
+import pytest
+
+import api_server
+from api_server import BrowserManager, PoolBusyError
+
+class FakePage:
+    def __init__(self):
+        self.url = api_server.QWEN_URL
+        self.closed = False
+        # CDP commands sent for this page before each navigation.
+        self.commands_before_goto = None
+
+    async def goto(self, url, **kwargs):
+        self.commands_before_goto = list(getattr(self, "cdp", FakeCDPSession()).commands)
+        self.url = url
+
+    async def close(self):
+        self.closed = True
+
+class FakeCDPSession:
+    def __init__(self):
+        self.commands = []
+        self.handlers = {}
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+
+    async def send(self, method, params=None):
+        self.commands.append((method, params))
+        return {}
+
+class FakeContext:
+    async def new_page(self):
+        return FakePage()
+
+    async def new_cdp_session(self, page):
+        page.cdp = FakeCDPSession()
+        return page.cdp
+
+@pytest.fixture(autouse=True)
+def no_background_page_work(monkeypatch):
+    # Pre-warming and recycling drive the real UI; these tests only cover the bookkeeping.
+    monkeypatch.setattr(api_server, "PREWARM_PAGES", 0)
+    monkeypatch.setattr(api_server, "RECYCLE_MAX_REQUESTS", 0)
+    monkeypatch.setattr(api_server, "RECYCLE_MAX_HEAP_MB", 0)
+
+async def make_pool(size: int, **kwargs) -> BrowserManager:
+    manager = BrowserManager(min_size=size, max_size=size, **kwargs)
+    manager.context = FakeContext()
+    for _ in range(size):
+        manager._hand_off(await manager._open_slot())
+    return manager
+
+def hand_off_then_raise(manager: BrowserManager, page, error: BaseException):
+    """A stand-in for asyncio.wait_for that loses the race: the page arrives, then `error` is raised."""
+    async def wait_for(future, timeout):
+        manager.release_page(page)
+        assert future.done()
+        raise error
+    return wait_for
+
+def test_page_handed_over_as_deadline_passes_goes_back_to_pool(monkeypatch):
+    async def main():
+        manager = await make_pool(1)
+        page = await manager.get_page()
+        monkeypatch.setattr(asyncio, "wait_for", hand_off_then_raise(manager, page, asyncio.TimeoutError()))
+        with pytest.raises(PoolBusyError) as error:
+            await manager.get_page(deadline=time.monotonic() + 60)
+        assert error.value.status == 504
+        assert len(manager.idle_slots) == 1 and not manager.waiters
+
+    asyncio.run(main())
+
+def test_page_handed_over_as_request_is_cancelled_goes_back_to_pool(monkeypatch):
+    async def main():
+        manager = await make_pool(1)
+        page = await manager.get_page()
+        monkeypatch.setattr(asyncio, "wait_for", hand_off_then_raise(manager, page, asyncio.CancelledError()))
+        with pytest.raises(asyncio.CancelledError):
+            await manager.get_page(deadline=time.monotonic() + 60)
+        assert len(manager.idle_slots) == 1 and not manager.waiters
+
+    asyncio.run(main())
+
+def test_timed_out_waiter_is_skipped_by_later_release():
+    async def main():
+        manager = await make_pool(1)
+        page = await manager.get_page()
+        with pytest.raises(PoolBusyError):
+            await manager.get_page(deadline=time.monotonic() + 0.01)
+        assert not manager.waiters
+        manager.release_page(page)
+        assert len(manager.idle_slots) == 1
+
+    asyncio.run(main())
+
+def test_full_queue_is_rejected():
+    async def main():
+        manager = await make_pool(1, max_queue=1)
+        page = await manager.get_page()
+        queued = asyncio.ensure_future(manager.get_page())
+        await asyncio.sleep(0)
+        with pytest.raises(PoolBusyError) as error:
+            await manager.get_page()
+        assert error.value.status == 503
+        manager.release_page(page)
+        assert await queued is page
+
+    asyncio.run(main())
+
+def test_url_patterns_are_blocked_through_cdp_before_the_first_load(monkeypatch):
+    monkeypatch.setattr(api_server, "BLOCKED_URL_PATTERNS", ["sentry.io", "/aplus"])
+
+    async def main():
+        manager = await make_pool(1)
+        page = manager.idle_slots[0].page
+        assert ("Network.setBlockedURLs", {"urls": ["*sentry.io*", "*/aplus*"]}) in page.commands_before_goto
+        page.cdp.handlers["Network.loadingFailed"]({"blockedReason": "inspector"})
+        page.cdp.handlers["Network.loadingFailed"]({"errorText": "net::ERR_FAILED"})
+        assert manager.blocked_requests == 1
+
+    asyncio.run(main())
+
+def test_turns_of_one_chat_run_in_arrival_order():
+    async def main():
+        from api_server import ChatTurnLock
+        lock = ChatTurnLock()
+        order = []
+
+        async def turn(name, chat_id):
+            await lock.acquire(chat_id)
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+            lock.release(chat_id)
+
+        await asyncio.gather(turn("a", "c1"), turn("b", "c1"), turn("c", "c1"), turn("other", "c2"))
+        c1 = [step for step in order if not step.startswith("other")]
+        assert c1 == ["a start", "a end", "b start", "b end", "c start", "c end"]
+        # A different chat isn't held up by c1.
+        assert order.index("other start") < order.index("a end")
+        assert not lock._turns
+
+    asyncio.run(main())
+
+def test_turn_that_times_out_leaves_the_queue():
+    async def main():
+        from api_server import ChatTurnLock
+        lock = ChatTurnLock()
+        await lock.acquire("c1")
+        with pytest.raises(PoolBusyError) as error:
+            await lock.acquire("c1", deadline=time.monotonic() + 0.01)
+        assert error.value.status == 504
+        waiting = asyncio.ensure_future(lock.acquire("c1"))
+        await asyncio.sleep(0)
+        lock.release("c1")
+        await asyncio.wait_for(waiting, 1)
+        lock.release("c1")
+        assert not lock._turns
+
+    asyncio.run(main())
+
+def test_turn_cancelled_as_it_is_granted_passes_it_on():
+    async def main():
+        from api_server import ChatTurnLock
+        lock = ChatTurnLock()
+        await lock.acquire("c1")
+        cancelled = asyncio.ensure_future(lock.acquire("c1"))
+        later = asyncio.ensure_future(lock.acquire("c1"))
+        await asyncio.sleep(0)
+        # The turn is granted and the waiter cancelled before it gets to run.
+        lock.release("c1")
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await asyncio.wait_for(later, 1)
+        lock.release("c1")
+        assert not lock._turns
+
+    asyncio.run(main())
+
+def pinned(manager: BrowserManager) -> list:
+    return [s.pinned_model for s in manager.slots.values() if not s.retiring]
+
+def test_recycled_pinned_page_hands_its_pin_to_the_replacement(monkeypatch):
+    monkeypatch.setattr(api_server, "POOL_MODEL_PINS", {"qwen-max": 1})
+
+    async def main():
+        manager = await make_pool(2)
+        old = next(s for s in manager.slots.values() if s.pinned_model)
+
+        async def recycle_reason(slot):
+            return "worn out" if slot is old else None
+
+        monkeypatch.setattr(manager, "_recycle_reason", recycle_reason)
+        manager.idle_slots.remove(old)
+        manager.release_page(old.page)
+        await asyncio.sleep(0.01)
+        assert old.page.closed and old.page not in manager.slots
+        assert pinned(manager).count("qwen-max") == 1 and len(manager.slots) == 2
+
+    asyncio.run(main())
+
+def test_reaping_keeps_the_only_pinned_page(monkeypatch):
+    monkeypatch.setattr(api_server, "POOL_MODEL_PINS", {"qwen-max": 1})
+
+    async def main():
+        manager = await make_pool(3, idle_timeout=0)
+        manager.min_size = 0
+        await manager._reap_idle()
+        assert pinned(manager) == ["qwen-max"]
+
+    asyncio.run(main())
+
+def test_closing_a_pinned_page_pins_an_idle_one(monkeypatch):
+    monkeypatch.setattr(api_server, "POOL_MODEL_PINS", {"qwen-max": 1})
+
+    async def main():
+        manager = await make_pool(2)
+        old = next(s for s in manager.slots.values() if s.pinned_model)
+        await manager._close_slot(old)
+        assert pinned(manager) == ["qwen-max"]
+
+    asyncio.run(main())
+
+def test_toggles_are_skipped_only_while_the_page_state_is_known(monkeypatch):
+    switches = []
+
+    async def select_model(page, model_name, timeout=10000):
+        switches.append(model_name)
+        if model_name == "broken":
+            raise RuntimeError("menu didn't open")
+
+    monkeypatch.setattr(api_server, "select_model", select_model)
+
+    async def main():
+        state = api_server.PageSlot(FakePage())
+        assert await api_server.ensure_model(state.page, state, "qwen-max")
+        assert not await api_server.ensure_model(state.page, state, "qwen-max")
+        with pytest.raises(RuntimeError):
+            await api_server.ensure_model(state.page, state, "broken")
+        # A switch that failed part way leaves the model unknown, so the next request sets it again.
+        assert state.model_name is None
+        assert await api_server.ensure_model(state.page, state, "qwen-max")
+        assert switches == ["qwen-max", "broken", "qwen-max"]
+
+    asyncio.run(main())
@@ -0,0 +1,178 @@
+import logging
+from collections import deque
+
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from utils import percentile
+
+log = logging.getLogger("qwen.browser")
+
+# Stage -> (default, floor, ceiling) in milliseconds. The default is the fixed timeout
+# used before the stage has been timed often enough for a model/agent. The reply and
+# image waits scale with the size of the answer, which the key doesn't know, so their
+# floors stay at the old fixed timeouts; "stall" is what frees a stuck page early: the
+# longest the page may go without new output during those waits.
+STAGE_TIMEOUTS = {
+    "navigation": (30000, 5000, 60000),
+    "new_chat": (15000, 3000, 30000),
+    "model_switch": (10000, 2000, 20000),
+    "agent": (10000, 2000, 20000),
+    "image_button": (15000, 3000, 30000),
+    "web_search": (10000, 2000, 20000),
+    "file_upload": (30000, 5000, 120000),
+    "submit": (30000, 5000, 60000),
+    "completion": (90000, 90000, 900000),
+    "image": (120000, 120000, 300000),
+    "stall": (60000, 10000, 180000),
+}
+
+def timeout_key(model_name: str = None, agent_name: str = None) -> str:
+    """Names the latency distribution a run belongs to: its model and agent."""
+    return f"{model_name or 'default'}/{agent_name or 'chat'}"
+
+def parse_timeout_overrides(value, main_stage: str) -> dict:
+    """
+    Validates a request's "timeouts" field: a number of seconds for `main_stage` (the
+    wait for the reply or the image), or an object of stage -> seconds. Raises ValueError.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = {main_stage: value}
+    if not isinstance(value, dict):
+        raise ValueError("'timeouts' must be a number of seconds or an object of stage -> seconds")
+    overrides = {}
+    for stage, seconds in value.items():
+        if stage not in STAGE_TIMEOUTS:
+            raise ValueError(f"Unknown timeout stage '{stage}'; expected one of {', '.join(STAGE_TIMEOUTS)}")
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds <= 0:
+            raise ValueError(f"Timeout for '{stage}' must be a positive number of seconds")
+        overrides[stage] = float(seconds)
+    return overrides
+
+def parse_timeout_limits(items: list[str]) -> dict:
+    """
+    Parses "stage=floor_ms:ceiling_ms" entries, e.g. ["completion=20000:1800000"].
+    Raises ValueError for unknown stages and malformed limits, so a typo stops the server
+    at startup instead of being ignored or breaking every request.
+    """
+    limits = {}
+    for item in items:
+        stage, _, value = item.partition("=")
+        stage = stage.strip()
+        if stage not in STAGE_TIMEOUTS:
+            raise ValueError(f"QWEN_TIMEOUT_LIMITS: unknown stage '{stage}'; expected one of {', '.join(STAGE_TIMEOUTS)}")
+        floor, sep, ceiling = value.partition(":")
+        try:
+            floor, ceiling = float(floor), float(ceiling)
+        except ValueError:
+            sep = ""
+        if not sep or not 0 < floor <= ceiling:
+            raise ValueError(f"QWEN_TIMEOUT_LIMITS: '{item}' must be stage=floor_ms:ceiling_ms with 0 < floor <= ceiling")
+        limits[stage] = (floor, ceiling)
+    return limits
+
+class StageTimeouts:
+    """
+    Learns a timeout for each browser stage from how long it recently took for each
+    model/agent: the `quantile`-th percentile of the last `window` successful runs
+    times `margin`, kept between the stage's floor and ceiling. Slow models and agents
+    get as long as they normally need, and a page that stops producing output is given
+    up on once it has been silent for longer than usual ("stall"), well before the
+    reply's own timeout.
+
+    Until a stage has `min_samples` runs its default is used. Whenever a run uses up its
+    timeout, learned or not, the timeout is raised by `margin` (up to the ceiling) for
+    the next `window` successful runs, so a model that has become slower, or an unusually long
+    answer, isn't cut off at the old worst case every time.
+    """
+    def __init__(self, quantile: float, margin: float, min_samples: int, window: int, limits: dict = None):
+        self.quantile = quantile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.window = window
+        self.limits = {}
+        for stage, (default, floor, ceiling) in STAGE_TIMEOUTS.items():
+            floor, ceiling = (limits or {}).get(stage, (floor, ceiling))
+            # Configured limits also bound the default, e.g. a lower ceiling for the reply.
+            self.limits[stage] = (min(ceiling, max(floor, default)), floor, ceiling)
+        # (stage, key) -> recent durations in milliseconds.
+        self._samples: dict[tuple, deque] = {}
+        # (stage, key) -> runs observed so far, to age out raised timeouts.
+        self._runs: dict[tuple, int] = {}
+        # (stage, key) -> (raised timeout, run count when it was raised).
+        self._raised: dict[tuple, tuple] = {}
+
+    def timeout_ms(self, stage: str, key: str) -> float:
+        default, floor, ceiling = self.limits[stage]
+        samples = self._samples.get((stage, key))
+        if samples is None or len(samples) < self.min_samples:
+            timeout = default
+        else:
+            timeout = min(ceiling, max(floor, percentile(samples, self.quantile) * self.margin))
+        raised = self._raised.get((stage, key))
+        if raised is not None:
+            if self._runs.get((stage, key), 0) - raised[1] < self.window:
+                timeout = max(timeout, raised[0])
+            else:
+                del self._raised[(stage, key)]
+        return timeout
+
+    def observe(self, stage: str, key: str, duration_ms: float):
+        samples = self._samples.get((stage, key))
+        if samples is None:
+            samples = self._samples[(stage, key)] = deque(maxlen=self.window)
+        samples.append(duration_ms)
+        self._runs[(stage, key)] = self._runs.get((stage, key), 0) + 1
+
+    def timed_out(self, stage: str, key: str, timeout_ms: float):
+        raised = min(self.limits[stage][2], timeout_ms * self.margin)
+        if raised > self.timeout_ms(stage, key):
+            self._raised[(stage, key)] = (raised, self._runs.get((stage, key), 0))
+            log.info(f"Stage ran out of time; allowing {raised / 1000:g}s for a while.", extra={"stage": stage})
+
+    def budget(self, key: str, overrides: dict = None) -> "TimeoutBudget":
+        return TimeoutBudget(self, key, overrides or {})
+
+    def stats(self) -> dict:
+        """Returns the current timeout (ms) and sample count per model/agent and stage."""
+        result = {}
+        for stage, key in sorted(self._samples.keys() | self._raised.keys(), key=lambda k: (k[1], k[0])):
+            result.setdefault(key, {})[stage] = {
+                "timeout_ms": round(self.timeout_ms(stage, key)),
+                "samples": len(self._samples.get((stage, key), ())),
+            }
+        return result
+
+class TimeoutBudget:
+    """The timeouts for one run: learned ones, except for stages the request overrides."""
+    def __init__(self, timeouts: StageTimeouts, key: str, overrides: dict):
+        self.timeouts = timeouts
+        self.key = key
+        self.overrides = overrides
+        # stage -> the timeout last handed out, to tell a run that used it all up.
+        self._given: dict[str, float] = {}
+
+    def ms(self, stage: str) -> float:
+        """Returns the timeout for `stage` in milliseconds. Overrides are capped at the stage's ceiling."""
+        if stage in self.overrides:
+            timeout = min(self.overrides[stage] * 1000, self.timeouts.limits[stage][2])
+        else:
+            timeout = self.timeouts.timeout_ms(stage, self.key)
+        self._given[stage] = timeout
+        return timeout
+
+    def record(self, stage: str, seconds: float, error: BaseException = None):
+        """
+        Learns from a finished stage. A stage that ran into its timeout, including one whose
+        timeout was caught and ignored, says only that it takes longer: it isn't a sample,
+        but raises the timeout for later runs.
+        """
+        given = self._given.get(stage)
+        duration_ms = seconds * 1000
+        ran_out = isinstance(error, PlaywrightTimeoutError) or (given is not None and duration_ms >= given)
+        if ran_out:
+            if given is not None and stage not in self.overrides:
+                self.timeouts.timed_out(stage, self.key, given)
+        elif error is None:
+            self.timeouts.observe(stage, self.key, duration_ms)
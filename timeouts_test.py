@@ -0,0 +1,86 @@
+# Run with: python -m pytest timeouts_test.py
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from timeouts import StageTimeouts, parse_timeout_limits, parse_timeout_overrides, timeout_key
+
+KEY = timeout_key()
+
+def make_timeouts() -> StageTimeouts:
+    return StageTimeouts(quantile=99, margin=2, min_samples=20, window=200)
+
+def run(timeouts: StageTimeouts, stage: str, seconds: float, timed_out: bool = False) -> float:
+    """Simulates one stage: takes its timeout, then reports how the run went. Returns the timeout used."""
+    budget = timeouts.budget(KEY)
+    given = budget.ms(stage)
+    if timed_out:
+        budget.record(stage, given / 1000, PlaywrightTimeoutError("timed out"))
+    else:
+        budget.record(stage, seconds)
+    return given
+
+def test_completion_timeout_does_not_collapse_after_short_replies():
+    timeouts = make_timeouts()
+    for _ in range(20):
+        run(timeouts, "completion", 5)
+    # Short replies must not make a 40 s answer fail.
+    assert timeouts.timeout_ms("completion", KEY) >= 40000
+    assert run(timeouts, "completion", 40) >= 40000
+
+def test_learned_timeout_is_raised_after_running_out():
+    timeouts = make_timeouts()
+    for _ in range(20):
+        run(timeouts, "submit", 1)
+    learned = timeouts.timeout_ms("submit", KEY)
+    assert learned == 5000  # The floor.
+    run(timeouts, "submit", 0, timed_out=True)
+    assert timeouts.timeout_ms("submit", KEY) == 2 * learned
+    run(timeouts, "submit", 0, timed_out=True)
+    assert timeouts.timeout_ms("submit", KEY) == 4 * learned
+
+def test_raised_timeout_ages_out():
+    timeouts = StageTimeouts(quantile=99, margin=2, min_samples=5, window=10)
+    for _ in range(5):
+        run(timeouts, "submit", 1)
+    run(timeouts, "submit", 0, timed_out=True)
+    assert timeouts.timeout_ms("submit", KEY) == 10000
+    for _ in range(10):
+        run(timeouts, "submit", 1)
+    assert timeouts.timeout_ms("submit", KEY) == 5000
+
+def test_cold_timeout_grows_up_to_ceiling():
+    timeouts = make_timeouts()
+    assert run(timeouts, "completion", 0, timed_out=True) == 90000
+    assert run(timeouts, "completion", 0, timed_out=True) == 180000
+    for _ in range(5):
+        run(timeouts, "completion", 0, timed_out=True)
+    assert timeouts.timeout_ms("completion", KEY) == 900000
+
+def test_override_is_capped_at_ceiling():
+    timeouts = make_timeouts()
+    assert timeouts.budget(KEY, {"completion": 5000}).ms("completion") == 900000
+    assert timeouts.budget(KEY, {"completion": 5}).ms("completion") == 5000
+
+def test_parse_timeout_overrides():
+    assert parse_timeout_overrides(None, "completion") is None
+    assert parse_timeout_overrides(30, "completion") == {"completion": 30.0}
+    for bad in ("x", {"bogus": 1}, {"submit": -1}, True):
+        try:
+            parse_timeout_overrides(bad, "completion")
+        except ValueError:
+            continue
+        raise AssertionError(f"{bad!r} was accepted")
+
+def test_image_button_keeps_its_longer_default():
+    timeouts = make_timeouts()
+    assert timeouts.timeout_ms("image_button", timeout_key(agent_name="Image Generation")) == 15000
+    assert timeouts.timeout_ms("agent", timeout_key(agent_name="Web Dev")) == 10000
+
+def test_parse_timeout_limits():
+    assert parse_timeout_limits([]) == {}
+    assert parse_timeout_limits([" completion=20000:1800000"]) == {"completion": (20000.0, 1800000.0)}
+    for bad in ("completion=20000", "complettion=1:2", "submit=a:b", "submit=5000:1000", "submit=0:1000", "submit"):
+        try:
+            parse_timeout_limits([bad])
+        except ValueError:
+            continue
+        raise AssertionError(f"{bad!r} was accepted")
@@ -0,0 +1,146 @@
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from pathlib import Path
+
+log = logging.getLogger("qwen.trace")
+
+# Id of the HTTP request being served; background work started by it inherits the id.
+current_request_id: ContextVar[str] = ContextVar("current_request_id", default=None)
+# Trace of the chat or image run in progress in this task, if it was sampled.
+current_trace: ContextVar["RequestTrace"] = ContextVar("current_trace", default=None)
+
+class RequestTrace:
+    """
+    A bounded timeline of one chat or image run: its stages and the page's
+    navigations, network requests and console messages. Only the newest
+    `max_events` events are kept, so a long run can't grow without bound.
+    """
+    def __init__(self, request_id: str, kind: str, max_events: int):
+        self.request_id = request_id
+        self.kind = kind
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.events = deque(maxlen=max_events)
+        self.dropped = 0
+        self.page = None
+        self.token = None
+        self._listeners = []
+
+    def add(self, event: str, **fields):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append({"t_ms": round((time.monotonic() - self.started) * 1000, 1), "event": event, **fields})
+
+    def attach(self, page):
+        """Starts recording the page's events into this trace."""
+        self.page = page
+        self._listeners = [
+            ("framenavigated", lambda frame: frame == page.main_frame and self.add("navigated", url=frame.url)),
+            ("request", lambda req: self.add("request", method=req.method, url=req.url, type=req.resource_type)),
+            ("response", lambda resp: self.add("response", status=resp.status, url=resp.url)),
+            ("requestfailed", lambda req: self.add("request_failed", url=req.url, failure=req.failure)),
+            ("console", lambda msg: self.add("console", level=msg.type, text=msg.text)),
+            ("pageerror", lambda error: self.add("page_error", message=str(error))),
+        ]
+        for name, listener in self._listeners:
+            page.on(name, listener)
+
+    def detach(self):
+        for name, listener in self._listeners:
+            try:
+                self.page.remove_listener(name, listener)
+            except Exception:
+                pass
+        self._listeners = []
+
+    def to_dict(self, status: str, error: str = None) -> dict:
+        return {
+            "request_id": self.request_id,
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "duration_ms": round((time.monotonic() - self.started) * 1000),
+            "status": status,
+            "error": error,
+            "dropped_events": self.dropped,
+            "events": list(self.events),
+        }
+
+class Tracer:
+    """
+    Samples chat and image runs for tracing and saves the traces of the slow and
+    failed ones as JSON files named after their request id. Traces of runs that
+    finish quickly and successfully are dropped without touching the disk.
+    """
+    def __init__(self, sample_rate: float, slow_seconds: float, max_events: int, directory: Path, max_files: int):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.max_events = max_events
+        self.directory = Path(directory)
+        self.max_files = max_files
+        self.saved = 0
+        self._seq = itertools.count(1)
+
+    def start(self, page, kind: str) -> RequestTrace:
+        """
+        Starts tracing a run on `page` if it is sampled, making it the current trace
+        so stage timings are recorded into it. Returns None if it isn't sampled.
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        trace = RequestTrace(current_request_id.get() or "untracked", kind, self.max_events)
+        trace.attach(page)
+        trace.token = current_trace.set(trace)
+        return trace
+
+    async def finish(self, trace: RequestTrace, result: dict):
+        """Stops the trace and saves it if the run failed or was slow."""
+        trace.detach()
+        current_trace.reset(trace.token)
+        elapsed = time.monotonic() - trace.started
+        failed = result.get("status") != "success"
+        if not failed and elapsed < self.slow_seconds:
+            return
+        data = trace.to_dict(result.get("status", "error"), result.get("message"))
+        name = f"{trace.request_id}-{next(self._seq)}.json"
+        try:
+            path = await asyncio.to_thread(self._write, name, data)
+            self.saved += 1
+            log.info(f"Saved {'failed' if failed else 'slow'} request trace: {path}")
+        except Exception as e:
+            log.warning(f"Could not save request trace: {e}")
+
+    async def run(self, page, kind: str, run):
+        """Awaits `run` (a chat or image run on `page`), tracing it if it is sampled."""
+        trace = self.start(page, kind)
+        if trace is None:
+            return await run
+        result = {"status": "error", "message": "Cancelled"}
+        try:
+            result = await run
+            return result
+        except Exception as e:
+            result = {"status": "error", "message": str(e)}
+            raise
+        finally:
+            await self.finish(trace, result)
+
+    def _write(self, name: str, data: dict) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / name
+        path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+        traces = sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for old in traces[:max(0, len(traces) - self.max_files)]:
+            old.unlink(missing_ok=True)
+        return path
+
+def record_stage(stage: str, seconds: float, failed: bool):
+    """Adds a finished `ask_qwen` stage to the current trace, if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add("stage", stage=stage, duration_ms=round(seconds * 1000, 1), failed=failed)
@@ -0,0 +1,295 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from werkzeug.utils import secure_filename
+
+log = logging.getLogger("qwen.uploads")
+
+# Bytes handed to the multipart decoder at a time, and the most a text field may hold.
+_FEED_SIZE = 64 * 1024
+_FIELD_MAX_BYTES = 1024 * 1024
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload is over the size or count limits."""
+
+class Upload:
+    """
+    One attached file. Small files stay in memory (`buffer`); larger ones live in the
+    UploadStore under their content hash (`path`), pinned until the request releases them.
+    """
+    def __init__(self, name: str, mime_type: str, sha256: str, size: int, buffer: bytes = None, path: Path = None):
+        self.name = name
+        self.mime_type = mime_type
+        self.sha256 = sha256
+        self.size = size
+        self.buffer = buffer
+        self.path = path
+        self.released = False
+
+class UploadStore:
+    """
+    Keeps uploaded files on disk by content hash, as `<directory>/<sha256>/<filename>`,
+    so a document sent again on a later turn is reused instead of written again.
+    The least recently used files are deleted once the store passes `max_bytes`,
+    skipping those still attached to a running request.
+    """
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.reused = 0
+        # sha256 -> bytes on disk, least recently used first; loaded on first use.
+        self._index: OrderedDict[str, int] = None
+        self._pins: dict[str, int] = {}
+        # Commits and evictions run in worker threads while the event loop pins and
+        # unpins; this guards the index, the pins and the folders they describe.
+        self._lock = threading.RLock()
+
+    def _load_index(self):
+        with self._lock:
+            if self._index is None:
+                self._read_index()
+
+    def _read_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for entry in self.directory.iterdir():
+            if entry.is_dir():
+                files = [f for f in entry.iterdir() if f.is_file()]
+                if files:
+                    entries.append((max(f.stat().st_mtime for f in files), entry.name, files[0].stat().st_size))
+            elif entry.name.endswith(".part"):
+                # Left behind by an upload that was cut off.
+                entry.unlink(missing_ok=True)
+        self._index = OrderedDict((name, size) for _, name, size in sorted(entries))
+
+    def temp_path(self) -> Path:
+        self._load_index()
+        return self.directory / f"{uuid.uuid4().hex}.part"
+
+    def commit(self, temp_path: Path, sha256: str, filename: str) -> Path:
+        """Moves a fully written upload into place, or drops it if the content is already stored."""
+        with self._lock:
+            return self._commit(temp_path, sha256, filename)
+
+    def _commit(self, temp_path: Path, sha256: str, filename: str) -> Path:
+        self._load_index()
+        folder = self.directory / sha256
+        path = folder / filename
+        if path.exists():
+            temp_path.unlink(missing_ok=True)
+            self.reused += 1
+        else:
+            folder.mkdir(exist_ok=True)
+            existing = next((f for f in folder.iterdir() if f.is_file()), None)
+            if existing is not None:
+                # Same content under another name: link to it instead of keeping a second copy.
+                try:
+                    os.link(existing, path)
+                except FileExistsError:
+                    pass
+                temp_path.unlink(missing_ok=True)
+                self.reused += 1
+            else:
+                os.replace(temp_path, path)
+        self._index[sha256] = path.stat().st_size
+        self._index.move_to_end(sha256)
+        self._evict()
+        return path
+
+    def store_bytes(self, data: bytes, sha256: str, filename: str) -> Path:
+        temp_path = self.temp_path()
+        temp_path.write_bytes(data)
+        return self.commit(temp_path, sha256, filename)
+
+    def _evict(self):
+        total = sum(self._index.values())
+        for sha256 in list(self._index):
+            if total <= self.max_bytes:
+                break
+            if self._pins.get(sha256):
+                continue
+            total -= self._index.pop(sha256)
+            folder = self.directory / sha256
+            for f in folder.iterdir():
+                f.unlink(missing_ok=True)
+            folder.rmdir()
+
+    def pin(self, sha256: str):
+        with self._lock:
+            self._pins[sha256] = self._pins.get(sha256, 0) + 1
+
+    def unpin(self, sha256: str):
+        with self._lock:
+            count = self._pins.get(sha256, 0) - 1
+            if count > 0:
+                self._pins[sha256] = count
+            else:
+                self._pins.pop(sha256, None)
+
+    def release(self, uploads: list):
+        """Lets the store evict the request's files again. Safe to call more than once."""
+        for upload in uploads or []:
+            if upload.path is not None and not upload.released:
+                self.unpin(upload.sha256)
+            upload.released = True
+
+    async def input_files(self, uploads: list) -> list:
+        """
+        Returns what to pass to Playwright's set_input_files: in-memory buffers when every
+        file is small, otherwise paths (storing the small files too, as the two can't be mixed).
+        """
+        if all(upload.buffer is not None for upload in uploads):
+            return [{"name": u.name, "mimeType": u.mime_type, "buffer": u.buffer} for u in uploads]
+        for upload in uploads:
+            if upload.path is None:
+                self.pin(upload.sha256)
+                upload.path = await asyncio.to_thread(self.store_bytes, upload.buffer, upload.sha256, upload.name)
+        return [str(upload.path) for upload in uploads]
+
+    async def read_multipart(self, request, max_file_bytes: int, max_total_bytes: int, max_files: int,
+                             memory_limit: int) -> tuple[dict, list]:
+        """
+        Parses a multipart/form-data request body as it arrives. Returns the text fields
+        and the uploaded files. Files up to `memory_limit` bytes stay in memory; larger
+        ones are written to the store in chunks while being hashed, so no upload is ever
+        held in memory or on disk twice. Raises UploadTooLargeError past the limits.
+        """
+        _, options = parse_options_header(request.headers.get("Content-Type", ""))
+        boundary = options.get("boundary", "").encode("latin-1")
+        if not boundary:
+            raise ValueError("Missing multipart boundary")
+        decoder = MultipartDecoder(boundary, max_form_memory_size=_FIELD_MAX_BYTES, max_parts=max_files + 32)
+        reader = _MultipartReader(self, max_file_bytes, max_total_bytes, max_files, memory_limit)
+        try:
+            async for body_chunk in request.body:
+                # The body arrives in large pieces if we fell behind reading it, and the
+                # decoder's buffer is bounded, so feed it a slice at a time.
+                for start in range(0, len(body_chunk), _FEED_SIZE):
+                    decoder.receive_data(body_chunk[start:start + _FEED_SIZE])
+                    await reader.drain(decoder)
+        except BaseException:
+            await reader.abort()
+            raise
+        return reader.fields, reader.uploads
+
+class _MultipartReader:
+    """Turns multipart decoder events into form fields and Uploads, enforcing the limits."""
+    def __init__(self, store: UploadStore, max_file_bytes: int, max_total_bytes: int, max_files: int, memory_limit: int):
+        self.store = store
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_files = max_files
+        self.memory_limit = memory_limit
+        self.fields: dict[str, str] = {}
+        self.uploads: list[Upload] = []
+        self.total = 0
+        self.part = None
+
+    async def drain(self, decoder: MultipartDecoder):
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File):
+                if len(self.uploads) >= self.max_files:
+                    raise UploadTooLargeError(f"At most {self.max_files} files may be attached.")
+                self.part = _FilePart(self.store, event, self.memory_limit)
+            elif isinstance(event, Field):
+                self.part = _FieldPart(event)
+            elif isinstance(event, Data):
+                await self._data(event)
+            event = decoder.next_event()
+
+    async def _data(self, event: Data):
+        part = self.part
+        if isinstance(part, _FilePart):
+            self.total += len(event.data)
+            if part.size + len(event.data) > self.max_file_bytes:
+                raise UploadTooLargeError(f"'{part.filename}' is larger than {self.max_file_bytes / (1024 * 1024):g} MB.")
+            if self.total > self.max_total_bytes:
+                raise UploadTooLargeError(f"Attachments are larger than {self.max_total_bytes / (1024 * 1024):g} MB in total.")
+        await part.write(event.data)
+        if event.more_data:
+            return
+        if isinstance(part, _FilePart):
+            upload = await part.finish()
+            if upload is not None:
+                self.uploads.append(upload)
+        else:
+            self.fields[part.name] = part.value()
+        self.part = None
+
+    async def abort(self):
+        """Cleans up after a request that was cut off or went over a limit."""
+        if isinstance(self.part, _FilePart):
+            await self.part.abort()
+        self.store.release(self.uploads)
+
+class _FieldPart:
+    def __init__(self, event: Field):
+        self.name = event.name
+        self._data = bytearray()
+
+    async def write(self, data: bytes):
+        self._data.extend(data)
+
+    def value(self) -> str:
+        return self._data.decode("utf-8", "replace")
+
+class _FilePart:
+    """One file being received: kept in memory until it outgrows `memory_limit`, then spilled to disk."""
+    def __init__(self, store: UploadStore, event: File, memory_limit: int):
+        self.store = store
+        # Browsers send an empty part with no filename for a file input left blank.
+        self.blank = not event.filename
+        self.filename = secure_filename(event.filename or "") or "upload"
+        self.mime_type = (event.headers.get("content-type")
+                          or mimetypes.guess_type(self.filename)[0] or "application/octet-stream")
+        self.memory_limit = memory_limit
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._buffer = bytearray()
+        self._temp_path: Path = None
+        self._file = None
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        self._digest.update(data)
+        if self._file is None and self.size <= self.memory_limit:
+            self._buffer.extend(data)
+            return
+        if self._file is None:
+            self._temp_path = self.store.temp_path()
+            self._file = await asyncio.to_thread(open, self._temp_path, "wb")
+            data, self._buffer = bytes(self._buffer) + data, bytearray()
+        await asyncio.to_thread(self._file.write, data)
+
+    async def finish(self) -> Upload:
+        """Returns the finished Upload, or None for an empty file input."""
+        sha256 = self._digest.hexdigest()
+        if self._file is None:
+            if self.size == 0 and self.blank:
+                return None
+            return Upload(self.filename, self.mime_type, sha256, self.size, buffer=bytes(self._buffer))
+        await asyncio.to_thread(self._file.close)
+        # Pinned first so committing (which may evict) can't remove it again.
+        self.store.pin(sha256)
+        try:
+            path = await asyncio.to_thread(self.store.commit, self._temp_path, sha256, self.filename)
+        except BaseException:
+            self.store.unpin(sha256)
+            raise
+        log.debug(f"Stored upload '{self.filename}' ({self.size} bytes) as {sha256[:12]}.")
+        return Upload(self.filename, self.mime_type, sha256, self.size, path=path)
+
+    async def abort(self):
+        if self._file is not None:
+            await asyncio.to_thread(self._file.close)
+            self._temp_path.unlink(missing_ok=True)
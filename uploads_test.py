@@ -0,0 +1,72 @@
+# Run with: python -m pytest uploads_test.py
+import asyncio
+import hashlib
+import time
+
+import api_server
+from uploads import Upload, UploadStore
+
+def stored_upload(store: UploadStore, data: bytes, name: str = "doc.pdf") -> Upload:
+    sha256 = hashlib.sha256(data).hexdigest()
+    store.pin(sha256)
+    path = store.store_bytes(data, sha256, name)
+    return Upload(name, "application/pdf", sha256, len(data), path=path)
+
+def test_pinned_uploads_survive_eviction(tmp_path):
+    store = UploadStore(tmp_path, max_bytes=100)
+    kept = stored_upload(store, b"a" * 80)
+    stored_upload(store, b"b" * 80)
+    assert kept.path.exists()
+    store.release([kept])
+    stored_upload(store, b"c" * 80)
+    assert not kept.path.exists()
+
+def test_commits_from_many_threads_keep_the_index_consistent(tmp_path):
+    async def main():
+        store = UploadStore(tmp_path, max_bytes=2000)
+
+        async def commit(i):
+            data = bytes([i % 40]) * 100
+            sha256 = hashlib.sha256(data).hexdigest()
+            store.pin(sha256)
+            await asyncio.to_thread(store.store_bytes, data, sha256, f"file{i % 3}.bin")
+            store.unpin(sha256)
+
+        await asyncio.gather(*(commit(i) for i in range(400)))
+        on_disk = {folder.name for folder in tmp_path.iterdir() if folder.is_dir()}
+        assert on_disk == set(store._index)
+        assert not store._pins
+
+    asyncio.run(main())
+
+def chat_params(upload: Upload) -> dict:
+    return {"prompt": "hi", "chat_id": "busy-chat", "use_web_search": False, "files": [upload],
+            "agent_name": None, "model_name": None, "timeouts": None}
+
+def test_uploads_are_released_when_the_turn_lock_times_out(tmp_path, monkeypatch):
+    async def main():
+        store = UploadStore(tmp_path, max_bytes=1 << 20)
+        monkeypatch.setattr(api_server, "upload_store", store)
+        turns = api_server.ChatTurnLock()
+        monkeypatch.setattr(api_server, "chat_turns", turns)
+        await turns.acquire("busy-chat")
+
+        upload = stored_upload(store, b"x" * 10)
+        try:
+            await api_server.run_chat(chat_params(upload), deadline=time.monotonic() + 0.01)
+        except api_server.PoolBusyError as e:
+            assert e.status == 504
+        assert not store._pins
+
+        upload = stored_upload(store, b"y" * 10)
+
+        async def parse_chat_request():
+            return chat_params(upload), None
+
+        monkeypatch.setattr(api_server, "parse_chat_request", parse_chat_request)
+        monkeypatch.setattr(api_server, "request_deadline", lambda: time.monotonic() + 0.01)
+        response = await api_server.app.test_client().post("/api/chat/stream", json={})
+        assert response.status_code == 504
+        assert not store._pins
+
+    asyncio.run(main())
@@ -1,5 +1,8 @@
 # c:\Users\itspr\DailyQuest\Qwen\utils.py
 import asyncio
+import json
+import math
+import os
 from pathlib import Path
 from playwright.async_api import async_playwright, Browser, Page, PlaywrightContextManager
 from playwright_stealth import Stealth
@@ -7,10 +10,220 @@ from playwright_stealth import Stealth
 # --- Constants ---
 PROJECT_ROOT = Path(__file__).resolve().parent
 STATE_FILE = PROJECT_ROOT / "storage_state.json"
-QWEN_URL = "https://chat.qwen.ai/"
+# Point this at mock_qwen_server.py (e.g. http://127.0.0.1:8020/) to run offline.
+QWEN_URL = os.environ.get("QWEN_URL", "https://chat.qwen.ai/")
 ERROR_SCREENSHOT_PATH = PROJECT_ROOT / "error_screenshot.png"
 ERROR_HTML_PATH = PROJECT_ROOT / "error_page.html"
 
+def env_list(name: str, default: str) -> list[str]:
+    """Reads a comma-separated list from the environment."""
+    return [item.strip() for item in os.environ.get(name, default).split(",") if item.strip()]
+
+# How ask_qwen detects and reads a finished response:
+#   "dom"     - wait for the regenerate button and scrape the rendered bubble.
+#   "network" - read the page's own completion stream and treat its end as completion.
+CAPTURE_MODE = os.environ.get("QWEN_CAPTURE_MODE", "dom")
+# Path fragment identifying the completion request the Qwen web app streams replies over.
+COMPLETION_URL_FRAGMENT = "/chat/completions"
+
+# Page pool sizing. The pool keeps at least POOL_MIN_SIZE tabs open and opens more,
+# up to POOL_MAX_SIZE, when a request has been queued longer than POOL_GROW_WAIT
+# seconds. Tabs idle for POOL_IDLE_TIMEOUT seconds are closed again.
+POOL_MIN_SIZE = int(os.environ.get("QWEN_POOL_MIN_SIZE", "3"))
+POOL_MAX_SIZE = int(os.environ.get("QWEN_POOL_MAX_SIZE", "6"))
+POOL_GROW_WAIT = float(os.environ.get("QWEN_POOL_GROW_WAIT", "2"))
+POOL_IDLE_TIMEOUT = float(os.environ.get("QWEN_POOL_IDLE_TIMEOUT", "600"))
+POOL_SCALE_INTERVAL = 1.0
+
+# Number of independent browsers (each with its own Playwright driver and page pool)
+# to spread requests over. The pool sizes above apply to each one.
+BROWSER_SHARDS = int(os.environ.get("QWEN_BROWSER_SHARDS", "1"))
+
+# Pooled pages are replaced after RECYCLE_MAX_REQUESTS requests, or once their used
+# JS heap reaches RECYCLE_MAX_HEAP_MB (checked every RECYCLE_CHECK_EVERY requests).
+# Set a limit to 0 to disable it.
+RECYCLE_MAX_REQUESTS = int(os.environ.get("QWEN_RECYCLE_MAX_REQUESTS", "200"))
+RECYCLE_MAX_HEAP_MB = float(os.environ.get("QWEN_RECYCLE_MAX_HEAP_MB", "512"))
+RECYCLE_CHECK_EVERY = int(os.environ.get("QWEN_RECYCLE_CHECK_EVERY", "10"))
+
+# Number of idle pages kept on a fresh "new chat" screen, with PREWARM_MODEL (if set)
+# selected and web search set to PREWARM_WEB_SEARCH, so new chats can start typing at once.
+PREWARM_PAGES = int(os.environ.get("QWEN_PREWARM_PAGES", "1"))
+PREWARM_MODEL = os.environ.get("QWEN_PREWARM_MODEL") or None
+PREWARM_WEB_SEARCH = os.environ.get("QWEN_PREWARM_WEB_SEARCH", "false").lower() == "true"
+
+# Pages kept on popular models, as "model=count" entries per pool (e.g. "Qwen3-Max=2").
+# New chats for a pinned model go to its pages, and pre-warming switches them back to it.
+POOL_MODEL_PINS = {
+    name.strip(): int(count)
+    for name, _, count in (item.rpartition("=") for item in env_list("QWEN_POOL_MODEL_PINS", ""))
+}
+
+# Admission control: at most MAX_QUEUE requests wait for a page per pool, and a request
+# waits at most DEFAULT_DEADLINE seconds unless it sends an X-Request-Deadline header.
+# DEFAULT_HOLD_TIME is the assumed page hold time before any have been measured.
+MAX_QUEUE = int(os.environ.get("QWEN_MAX_QUEUE", "32"))
+DEFAULT_DEADLINE = float(os.environ.get("QWEN_DEFAULT_DEADLINE", "60"))
+DEFAULT_HOLD_TIME = 30.0
+
+# Metadata (model list, current model, chat history) is cached for METADATA_TTL seconds,
+# then served stale for up to METADATA_MAX_STALE more seconds while it is refreshed on
+# an idle page. METADATA_TTL=0 disables caching.
+METADATA_TTL = float(os.environ.get("QWEN_METADATA_TTL", "300"))
+METADATA_MAX_STALE = float(os.environ.get("QWEN_METADATA_MAX_STALE", "3600"))
+
+# Opt-in cache of /api/chat responses for repeatable new-chat prompts (no chat_id, no
+# web search): RESPONSE_CACHE_MAX_ENTRIES results in memory, backed by JSON files in
+# RESPONSE_CACHE_DIR capped at RESPONSE_CACHE_MAX_MB.
+RESPONSE_CACHE_ENABLED = os.environ.get("QWEN_RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_DIR = Path(os.environ.get("QWEN_RESPONSE_CACHE_DIR", PROJECT_ROOT / "response_cache"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("QWEN_RESPONSE_CACHE_MAX_ENTRIES", "256"))
+RESPONSE_CACHE_MAX_MB = float(os.environ.get("QWEN_RESPONSE_CACHE_MAX_MB", "100"))
+
+# Requests the pooled browser doesn't load. URLs containing one of BLOCKED_URL_PATTERNS
+# (analytics and error beacons) are blocked in each page through CDP, which keeps the
+# HTTP cache. BLOCKED_RESOURCE_TYPES (e.g. "image,font,media") are aborted by a Playwright
+# route instead, which disables the HTTP cache for the whole context, so every new tab
+# downloads the app's scripts and styles again; it is off unless set. URLs containing
+# one of ALLOWED_URL_PATTERNS (the chat and image APIs) pass the resource type filter.
+BLOCKED_RESOURCE_TYPES = env_list("QWEN_BLOCKED_RESOURCE_TYPES", "")
+BLOCKED_URL_PATTERNS = env_list(
+    "QWEN_BLOCKED_URL_PATTERNS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,hm.baidu.com,sentry.io,/aplus,arms-retcode,mmstat.com",
+)
+ALLOWED_URL_PATTERNS = env_list("QWEN_ALLOWED_URL_PATTERNS", "/api/")
+
+# /api/chat/batch accepts up to BATCH_MAX_ITEMS prompts and runs at most
+# BATCH_CONCURRENCY of them at once per batch (by default, the most pages the pool can hold).
+BATCH_MAX_ITEMS = int(os.environ.get("QWEN_BATCH_MAX_ITEMS", "100"))
+BATCH_CONCURRENCY = int(os.environ.get("QWEN_BATCH_CONCURRENCY", str(POOL_MAX_SIZE * BROWSER_SHARDS)))
+
+# Background jobs (/api/jobs): at most JOB_CONCURRENCY run against the pool at once and
+# JOB_MAX_PENDING may wait; finished jobs are kept for JOB_RETENTION seconds.
+JOB_CONCURRENCY = int(os.environ.get("QWEN_JOB_CONCURRENCY", str(POOL_MAX_SIZE * BROWSER_SHARDS)))
+JOB_MAX_PENDING = int(os.environ.get("QWEN_JOB_MAX_PENDING", "1000"))
+JOB_RETENTION = float(os.environ.get("QWEN_JOB_RETENTION", "3600"))
+
+# Chat-affinity routing in the page pool: how far down the wait queue a released page
+# may look for a request on the chat it is showing, and how often one waiting request
+# may be overtaken that way before it is served regardless.
+AFFINITY_WINDOW = int(os.environ.get("QWEN_AFFINITY_WINDOW", "8"))
+AFFINITY_MAX_SKIPS = int(os.environ.get("QWEN_AFFINITY_MAX_SKIPS", "2"))
+
+# Sampled request tracing: TRACE_SAMPLE_RATE of chat and image requests (0 disables it)
+# record a timeline of stages and page events, kept only for requests that fail or take
+# longer than TRACE_SLOW_SECONDS. At most TRACE_MAX_EVENTS events are kept per request
+# and the newest TRACE_MAX_FILES traces are kept in TRACE_DIR.
+TRACE_SAMPLE_RATE = float(os.environ.get("QWEN_TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_SECONDS = float(os.environ.get("QWEN_TRACE_SLOW_SECONDS", "30"))
+TRACE_MAX_EVENTS = int(os.environ.get("QWEN_TRACE_MAX_EVENTS", "2000"))
+TRACE_MAX_FILES = int(os.environ.get("QWEN_TRACE_MAX_FILES", "50"))
+TRACE_DIR = Path(os.environ.get("QWEN_TRACE_DIR", str(PROJECT_ROOT / "traces")))
+
+# Error screenshots and HTML saved by the server: one capture per request into
+# ERROR_ARTIFACT_DIR, at most ERROR_ARTIFACT_PER_MINUTE captures a minute (ERROR_ARTIFACT_BURST
+# at once), each given ERROR_CAPTURE_TIMEOUT seconds, and the oldest files are deleted once
+# the directory passes ERROR_ARTIFACT_MAX_MB.
+ERROR_ARTIFACT_DIR = Path(os.environ.get("QWEN_ERROR_ARTIFACT_DIR", str(PROJECT_ROOT / "error_artifacts")))
+ERROR_ARTIFACT_MAX_MB = float(os.environ.get("QWEN_ERROR_ARTIFACT_MAX_MB", "50"))
+ERROR_ARTIFACT_PER_MINUTE = float(os.environ.get("QWEN_ERROR_ARTIFACT_PER_MINUTE", "6"))
+ERROR_ARTIFACT_BURST = int(os.environ.get("QWEN_ERROR_ARTIFACT_BURST", "3"))
+ERROR_CAPTURE_TIMEOUT = float(os.environ.get("QWEN_ERROR_CAPTURE_TIMEOUT", "5"))
+
+# Server logging: LOG_LEVEL for the "qwen" loggers, LOG_FORMAT "text" or "json", and
+# LOG_SAMPLE as "logger=rate" entries (e.g. "qwen.pool=0.1") to keep only that share of
+# a logger's records below WARNING. At most LOG_QUEUE_SIZE records wait for the writer
+# thread; more are dropped rather than blocking the server.
+LOG_LEVEL = os.environ.get("QWEN_LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("QWEN_LOG_FORMAT", "text")
+LOG_SAMPLE = env_list("QWEN_LOG_SAMPLE", "")
+LOG_QUEUE_SIZE = int(os.environ.get("QWEN_LOG_QUEUE_SIZE", "10000"))
+
+# Chat attachments: at most UPLOAD_MAX_FILES files of UPLOAD_MAX_FILE_MB each and
+# UPLOAD_MAX_TOTAL_MB together per request. Files up to UPLOAD_MEMORY_LIMIT_KB are handed
+# to the browser from memory; larger ones are kept in UPLOAD_DIR by content hash, which
+# is trimmed to UPLOAD_STORE_MAX_MB.
+UPLOAD_MAX_FILES = int(os.environ.get("QWEN_UPLOAD_MAX_FILES", "10"))
+UPLOAD_MAX_FILE_MB = float(os.environ.get("QWEN_UPLOAD_MAX_FILE_MB", "25"))
+UPLOAD_MAX_TOTAL_MB = float(os.environ.get("QWEN_UPLOAD_MAX_TOTAL_MB", "50"))
+UPLOAD_MEMORY_LIMIT_KB = float(os.environ.get("QWEN_UPLOAD_MEMORY_LIMIT_KB", "1024"))
+UPLOAD_DIR = Path(os.environ.get("QWEN_UPLOAD_DIR", str(PROJECT_ROOT / "temp_uploads")))
+UPLOAD_STORE_MAX_MB = float(os.environ.get("QWEN_UPLOAD_STORE_MAX_MB", "500"))
+
+# Generated images are copied out of the page into IMAGE_DIR. With Pillow installed,
+# IMAGE_THUMBNAIL_SIZE > 0 also makes thumbnails of that many pixels on the longest
+# side, using IMAGE_THUMBNAIL_WORKERS worker processes.
+IMAGE_DIR = Path(os.environ.get("QWEN_IMAGE_DIR", str(PROJECT_ROOT / "generated_images")))
+IMAGE_THUMBNAIL_SIZE = int(os.environ.get("QWEN_IMAGE_THUMBNAIL_SIZE", "0"))
+IMAGE_THUMBNAIL_WORKERS = int(os.environ.get("QWEN_IMAGE_THUMBNAIL_WORKERS", "2"))
+
+# Browser waits in ask_qwen and generate_qwen_image use timeouts learned per stage and
+# model/agent: the TIMEOUT_PERCENTILE-th percentile of the last TIMEOUT_WINDOW successful
+# runs times TIMEOUT_MARGIN, kept between the stage's floor and ceiling (see timeouts.py).
+# Fixed defaults apply until a stage has TIMEOUT_MIN_SAMPLES runs. TIMEOUT_LIMITS changes
+# floors and ceilings as "stage=floor_ms:ceiling_ms" entries (e.g. "completion=20000:1800000").
+TIMEOUT_PERCENTILE = float(os.environ.get("QWEN_TIMEOUT_PERCENTILE", "99"))
+TIMEOUT_MARGIN = float(os.environ.get("QWEN_TIMEOUT_MARGIN", "2"))
+TIMEOUT_MIN_SAMPLES = int(os.environ.get("QWEN_TIMEOUT_MIN_SAMPLES", "20"))
+TIMEOUT_WINDOW = int(os.environ.get("QWEN_TIMEOUT_WINDOW", "200"))
+TIMEOUT_LIMITS = env_list("QWEN_TIMEOUT_LIMITS", "")
+
+def percentile(values, q: float) -> float:
+    """Returns the q-th percentile (0-100) of `values` by nearest rank, or 0.0 if there are none."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def chat_id_from_url(url: str) -> str | None:
+    """Returns the chat id from a chat.qwen.ai/c/<id> URL, or None if the URL isn't a chat."""
+    if "/c/" not in url:
+        return None
+    return url.split('/c/')[1].split('?')[0].split('#')[0] or None
+
+def parse_completion_stream(body: str) -> dict:
+    """
+    Parses the Server-Sent Events body of a Qwen completion request.
+
+    Only the answer phase is collected, so "thinking" output and web search
+    progress don't end up in the reply. The content is the raw markdown the
+    model produced, before the UI renders it.
+
+    Returns:
+        A dict with the reply `text`, the `chat_id` (if the stream reported one)
+        and whether the stream signalled that it `finished`.
+    """
+    text_parts = []
+    chat_id = None
+    finished = False
+    for line in body.splitlines():
+        line = line.strip()
+        if not line.startswith("data:"):
+            continue
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            finished = True
+            continue
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            continue
+        if not isinstance(event, dict):
+            continue
+
+        created = event.get("response.created")
+        if isinstance(created, dict) and created.get("chat_id"):
+            chat_id = created["chat_id"]
+
+        for choice in event.get("choices") or []:
+            delta = choice.get("delta") or {}
+            if delta.get("phase") in (None, "answer") and delta.get("content"):
+                text_parts.append(delta["content"])
+            if delta.get("status") == "finished" or choice.get("finish_reason"):
+                finished = True
+    return {"text": "".join(text_parts), "chat_id": chat_id, "finished": finished}
+
 async def setup_browser_page(p: PlaywrightContextManager, headless: bool = False) -> tuple[Browser, Page]:
     """
     Handles the common boilerplate for setting up a Playwright browser and page.
@@ -58,6 +271,7 @@ async def save_error_state(page: Page):
     """
     Saves a screenshot and the full page HTML for debugging purposes.
     Inspired by snapdom's approach to capturing page state on failure.
+    Used by the standalone scripts; the server saves through ErrorArtifactStore instead.
     """
     print(f"[!] Saving screenshot to '{ERROR_SCREENSHOT_PATH}'")
     await page.screenshot(path=ERROR_SCREENSHOT_PATH, full_page=True)